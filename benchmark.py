@@ -0,0 +1,319 @@
+# benchmark.py — قياس أداء البوت دون اتصال: Bot API وهمي + مستخدمون اصطناعيون + Postgres مؤقت
+#
+#   python benchmark.py --pairs 200 --concurrency 20 --out bench.json
+#   python benchmark.py --pairs 200 --baseline bench.json      # مقارنة بتشغيل سابق
+#
+# قاعدة البيانات: إن وُجد initdb/pg_ctl في PATH يُنشأ عنقود مؤقت ويُحذف بعد التشغيل،
+# وإلا تُستخدم BENCH_DATABASE_URL لإنشاء قاعدة مؤقتة (jetoor_bench_<pid>) على ذلك الخادم ثم حذفها.
+# كل زوج مستخدمين (مُحيل + مُحال) يمر بالمراحل بالترتيب:
+#   start → subscribe → approve → referral → withdraw
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from fake_telegram import FakeBotAPI, message_update, photo_update, callback_update
+
+logger = logging.getLogger("benchmark")
+
+USER_BASE = 500_000_000
+ADMIN_BASE = 900_000_000
+FLOWS = ("start", "subscribe", "approve", "referral", "withdraw")
+
+
+# ---------------- POSTGRES ----------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalPostgres:
+    """عنقود Postgres مؤقت في مجلد temp (fsync معطّل) يُحذف عند الإيقاف"""
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="jetoor-bench-")
+        self.data = os.path.join(self.dir, "data")
+        self.port = _free_port()
+
+    @property
+    def url(self) -> str:
+        return f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    def start(self):
+        subprocess.run(["initdb", "-D", self.data, "-U", "postgres", "-A", "trust"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([
+            "pg_ctl", "-D", self.data, "-l", os.path.join(self.dir, "log"), "-w",
+            "-o", f"-p {self.port} -k {self.dir} -c listen_addresses=127.0.0.1 -F -c max_connections=200",
+            "start",
+        ], check=True, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        subprocess.run(["pg_ctl", "-D", self.data, "-m", "fast", "-w", "stop"],
+                       check=False, stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class ServerDatabase:
+    """قاعدة مؤقتة على خادم موجود (BENCH_DATABASE_URL) تُحذف بعد التشغيل"""
+
+    def __init__(self, server_url: str):
+        from psycopg.conninfo import make_conninfo
+        self.server_url = server_url
+        self.name = f"jetoor_bench_{os.getpid()}"
+        self.url = make_conninfo(server_url, dbname=self.name)
+
+    def _admin(self, statement: str):
+        import psycopg
+        from psycopg import sql
+        with psycopg.connect(self.server_url, autocommit=True) as conn:
+            conn.execute(sql.SQL(statement).format(sql.Identifier(self.name)))
+
+    def start(self):
+        self._admin("CREATE DATABASE {}")
+
+    def stop(self):
+        self._admin("DROP DATABASE IF EXISTS {} WITH (FORCE)")
+
+
+def disposable_database():
+    if shutil.which("initdb") and shutil.which("pg_ctl"):
+        return LocalPostgres()
+    if os.getenv("BENCH_DATABASE_URL"):
+        return ServerDatabase(os.environ["BENCH_DATABASE_URL"])
+    sys.exit("❌ No initdb/pg_ctl on PATH and BENCH_DATABASE_URL is not set.")
+
+
+# ---------------- STATS ----------------
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+class FlowStats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.seconds = 0.0
+
+    def summary(self) -> dict:
+        lat = sorted(self.latencies)
+        return {
+            "updates": len(lat),
+            "seconds": round(self.seconds, 3),
+            "updates_per_sec": round(len(lat) / self.seconds, 1) if self.seconds else 0.0,
+            "p50_ms": round(percentile(lat, 50) * 1000, 2),
+            "p95_ms": round(percentile(lat, 95) * 1000, 2),
+            "p99_ms": round(percentile(lat, 99) * 1000, 2),
+            "max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+        }
+
+
+# ---------------- SYNTHETIC USERS ----------------
+class Driver:
+    """يُرسل التحديثات مباشرة إلى app.process_update ويقيس زمن كل تحديث"""
+
+    def __init__(self, app, stats: dict[str, FlowStats]):
+        from telegram import Update
+        self.app = app
+        self.stats = stats
+        self._update_cls = Update
+        self._ids = itertools.count(1)
+
+    async def send(self, flow: str, build, *args, **kwargs):
+        payload = build(next(self._ids), *args, **kwargs)
+        update = self._update_cls.de_json(payload, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.stats[flow].latencies.append(time.perf_counter() - started)
+
+    # ---- خطوات ----
+    async def start(self, flow: str, user: int, ref: int = None):
+        await self.send(flow, message_update, user, f"/start {ref}" if ref else "/start")
+
+    async def subscribe(self, flow: str, user: int, method_id: int):
+        await self.send(flow, callback_update, user, "menu:subscribe")
+        await self.send(flow, callback_update, user, f"paymethod:{method_id}")
+        await self.send(flow, photo_update, user, f"proof-{user}")
+
+    async def approve(self, flow: str, admin: int, user: int):
+        from database import safe_db_fetchone
+        row = await safe_db_fetchone(
+            "SELECT id FROM payments WHERE user_id = %s AND status = 'PENDING' ORDER BY id DESC LIMIT 1", (user,)
+        )
+        if not row:
+            raise RuntimeError(f"no pending payment for {user}")
+        await self.send(flow, callback_update, admin, f"approve:{row['id']}")
+        await self.send(flow, message_update, admin, f"TXN-{row['id']}")
+
+    async def withdraw(self, flow: str, admin: int, user: int):
+        from database import safe_db_fetchone
+        await self.send(flow, callback_update, user, "menu:withdraw")
+        await self.send(flow, callback_update, user, "withdraw:sham")
+        await self.send(flow, message_update, user, f"SHAM{user}")
+        await self.send(flow, callback_update, user, "confirm:withdraw")
+        row = await safe_db_fetchone(
+            "SELECT id FROM withdrawals WHERE user_id = %s AND status = 'PENDING' ORDER BY id DESC LIMIT 1", (user,)
+        )
+        if not row:
+            raise RuntimeError(f"no pending withdrawal for {user}")
+        await self.send(flow, callback_update, admin, f"pay:{row['id']}")
+        await self.send(flow, message_update, admin, f"PAYOUT-{row['id']}")
+
+
+async def run_phase(name: str, pairs: list[tuple[int, int]], concurrency: int, step, stats: FlowStats) -> int:
+    """تشغيل مرحلة لكل الأزواج بعدد عمال ثابت؛ كل عامل يستخدم أدمن خاصًا به حتى لا تتداخل حالاتهم"""
+    queue: asyncio.Queue = asyncio.Queue()
+    for pair in pairs:
+        queue.put_nowait(pair)
+    failures = 0
+
+    async def worker(admin: int):
+        nonlocal failures
+        while not queue.empty():
+            referrer, referred = queue.get_nowait()
+            try:
+                await step(admin, referrer, referred)
+            except Exception as e:
+                failures += 1
+                logger.warning(f"{name} failed for {referrer}: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(ADMIN_BASE + i) for i in range(concurrency)))
+    stats.seconds = time.perf_counter() - started
+    return failures
+
+
+async def benchmark(args) -> dict:
+    db = disposable_database()
+    db.start()
+    api = FakeBotAPI(port=0, latency=args.api_latency)
+    await api.start()
+    os.environ.update({
+        "DATABASE_URL": db.url,
+        "BOT_TOKEN": "123456:bench",
+        "ADMINS": ",".join(str(ADMIN_BASE + i) for i in range(args.concurrency)),
+        "BOT_API_URL": api.url,
+        "LINK_GENERATOR": "fake",
+        "DB_POOL_MAX": str(args.pool_size),
+        "METRICS_PORT": "0",
+    })
+    app = None
+    try:
+        import jetoor
+        from database import safe_db_execute, safe_db_fetchone
+        from settings_cache import settings
+
+        logging.getLogger().setLevel(logging.WARNING)
+        app = jetoor.build_application()
+        errors = []
+
+        async def count_errors(update, context):
+            errors.append(repr(context.error))
+        app.add_error_handler(count_errors)
+
+        await app.initialize()
+        await jetoor.on_startup(app)
+        await app.start()
+
+        # بيانات أولية: طريقة دفع، ومكافأة إحالة تكفي لتجاوز حد السحب من إحالة واحدة
+        row = await safe_db_fetchone(
+            "INSERT INTO payment_methods (name, barcode) VALUES ('Bench', 'bench-barcode') RETURNING id"
+        )
+        method_id = row["id"]
+        await settings.set("referral_reward", await settings.get("min_withdraw"))
+
+        stats = {flow: FlowStats() for flow in FLOWS}
+        driver = Driver(app, stats)
+        pairs = [(USER_BASE + 2 * i, USER_BASE + 2 * i + 1) for i in range(args.pairs)]
+
+        steps = {
+            "start": lambda admin, r, v: driver.start("start", r),
+            "subscribe": lambda admin, r, v: driver.subscribe("subscribe", r, method_id),
+            "approve": lambda admin, r, v: driver.approve("approve", admin, r),
+            "referral": lambda admin, r, v: _referral(driver, admin, r, v, method_id),
+            "withdraw": lambda admin, r, v: driver.withdraw("withdraw", admin, r),
+        }
+        failures = {}
+        for flow in FLOWS:
+            failures[flow] = await run_phase(flow, pairs, args.concurrency, steps[flow], stats[flow])
+            logger.warning(f"✅ {flow}: {stats[flow].summary()}")
+
+        return {
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "config": {
+                "pairs": args.pairs, "concurrency": args.concurrency,
+                "api_latency": args.api_latency, "pool_size": args.pool_size,
+                "persist_state": jetoor.PERSIST_STATE,
+            },
+            "flows": {flow: {**stats[flow].summary(), "failures": failures[flow]} for flow in FLOWS},
+            "handler_errors": len(errors),
+            "bot_api_calls": len(api.calls),
+        }
+    finally:
+        if app is not None:
+            if app.running:
+                await app.stop()
+            import jetoor
+            await jetoor.on_shutdown(app)
+            await app.shutdown()
+        await api.stop()
+        db.stop()
+
+
+async def _referral(driver: Driver, admin: int, referrer: int, referred: int, method_id: int):
+    """المُحال يبدأ برابط الإحالة ويشترك، ثم يُعتمد دفعه فيُكافأ المُحيل"""
+    await driver.start("referral", referred, referrer)
+    await driver.subscribe("referral", referred, method_id)
+    await driver.approve("referral", admin, referred)
+    await driver.send("referral", callback_update, referrer, "menu:referral")
+
+
+def compare(current: dict, baseline: dict) -> str:
+    lines = [f"{'flow':<10} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16} {'upd/s':>16}"]
+    for flow, now in current["flows"].items():
+        old = baseline.get("flows", {}).get(flow)
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "updates_per_sec"):
+            if old and old.get(key):
+                cells.append(f"{now[key]} ({(now[key] - old[key]) / old[key] * 100:+.0f}%)")
+            else:
+                cells.append(str(now[key]))
+        lines.append(f"{flow:<10} " + " ".join(f"{c:>16}" for c in cells))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline Jetoor benchmark")
+    parser.add_argument("--pairs", type=int, default=100, help="referrer/referred user pairs")
+    parser.add_argument("--concurrency", type=int, default=10, help="parallel synthetic users (and admins)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API delay per call (s)")
+    parser.add_argument("--pool-size", type=int, default=10, help="DB_POOL_MAX for the run")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = asyncio.run(benchmark(args))
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result["flows"], indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(result, json.load(f)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# broadcast.py — محرك البث الجماعي: إرسال منظّم المعدل مع مهام قابلة للاستئناف
+import os
+import time
+import asyncio
+import logging
+from telegram import Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+from database import safe_db_execute, safe_db_fetchone, safe_db_fetchall
+from ratelimit import TokenBucket, GLOBAL_RATE, throttle
+from metrics import BROADCAST_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+# حصة البث من الميزانية العامة (TG_GLOBAL_RATE)؛ الباقي يبقى متاحًا لإشعارات الصندوق الصادر
+BROADCAST_SHARE = float(os.getenv("BROADCAST_SHARE", "0.8"))
+BROADCAST_RATE = GLOBAL_RATE * BROADCAST_SHARE
+# عدد المستلمين بين كل حفظ للتقدم (أقصى ما قد يُعاد إرساله بعد انهيار)
+CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "25"))
+# عدد المستلمين في كل جلب (keyset)؛ الاتصال يعود للمجمّع فور الجلب ولا يبقى مفتوحًا أثناء الإرسال
+STREAM_WINDOW = int(os.getenv("BROADCAST_STREAM_WINDOW", "5000"))
+PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "15"))
+MAX_RETRIES = 3
+
+_share = TokenBucket(BROADCAST_RATE)
+
+
+async def create_job(admin_id: int, text: str) -> int | None:
+    """إنشاء مهمة بث جديدة؛ يُرجع None إن لم يوجد مستخدمون"""
+    row = await safe_db_fetchone("""
+        INSERT INTO broadcast_jobs (admin_id, text, total)
+        SELECT %s, %s, count(*) FROM users
+        HAVING count(*) > 0
+        RETURNING id
+    """, (admin_id, text))
+    return row["id"] if row else None
+
+
+async def set_progress_message(job_id: int, message_id: int):
+    await safe_db_execute(
+        "UPDATE broadcast_jobs SET progress_message_id = %s WHERE id = %s", (message_id, job_id)
+    )
+
+
+async def _send(bot: Bot, chat_id: int, text: str) -> bool:
+    """إرسال رسالة واحدة مع احترام RetryAfter وحدود المعدل"""
+    for attempt in range(MAX_RETRIES):
+        await _share.acquire()
+        await throttle.wait(chat_id)
+        try:
+            await bot.send_message(chat_id, text, parse_mode=None)
+            return True
+        except RetryAfter as e:
+            logger.warning(f"⏳ Flood wait {e.retry_after}s during broadcast")
+            throttle.flood_wait(e.retry_after)
+        except (Forbidden, BadRequest):
+            return False
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(2 ** attempt)
+    return False
+
+
+def _progress_text(job: dict, sent: int, failed: int, started: float, done_at_start: int, final=False) -> str:
+    done = sent + failed
+    elapsed = max(time.monotonic() - started, 1e-6)
+    rate = (done - done_at_start) / elapsed
+    remaining = max(job["total"] - done, 0)
+    eta = f"{remaining / rate / 60:.1f} د" if rate > 0 else "---"
+    head = "✅ اكتمل البث" if final else "📢 جارٍ البث"
+    return (
+        f"{head} #{job['id']}\n"
+        f"✅ {sent} | ❌ {failed} | 📊 {done}/{job['total']}\n"
+        f"⚡ {rate:.1f} رسالة/ث" + ("" if final else f" | ⏳ المتبقي ~{eta}")
+    )
+
+
+async def _report(bot: Bot, job: dict, text: str):
+    if not job["progress_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=job["admin_id"], message_id=job["progress_message_id"])
+    except Exception as e:
+        logger.warning(f"Broadcast progress update failed: {e}")
+
+
+async def run_job(bot: Bot, job_id: int):
+    """تنفيذ مهمة البث من آخر نقطة محفوظة حتى النهاية"""
+    job = await safe_db_fetchone("SELECT * FROM broadcast_jobs WHERE id = %s AND status = 'RUNNING'", (job_id,))
+    if not job:
+        return
+    sent, failed, last_id = job["sent"], job["failed"], job["last_user_id"]
+    started, done_at_start, reported = time.monotonic(), sent + failed, time.monotonic()
+
+    async def deliver(chunk: list):
+        """إرسال دفعة من المستلمين ثم حفظ التقدم"""
+        nonlocal sent, failed, last_id
+        results = await asyncio.gather(*(_send(bot, c["telegram_id"], job["text"]) for c in chunk))
+        sent += sum(results)
+        failed += len(results) - sum(results)
+        BROADCAST_MESSAGES.inc("sent", amount=sum(results))
+        BROADCAST_MESSAGES.inc("failed", amount=len(results) - sum(results))
+        last_id = chunk[-1]["id"]
+        await safe_db_execute("""
+            UPDATE broadcast_jobs SET last_user_id = %s, sent = %s, failed = %s, updated_at = NOW()
+            WHERE id = %s
+        """, (last_id, sent, failed, job_id))
+
+    logger.info(f"📢 Broadcast #{job_id} running from user id > {last_id}")
+    while True:
+        window_start, chunk = last_id, []
+        window = await safe_db_fetchall(
+            "SELECT id, telegram_id FROM users WHERE id > %s ORDER BY id LIMIT %s",
+            (window_start, STREAM_WINDOW)
+        )
+        for r in window:
+            chunk.append(r)
+            if len(chunk) < CHECKPOINT_EVERY:
+                continue
+            await deliver(chunk)
+            chunk = []
+            if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                await _report(bot, job, _progress_text(job, sent, failed, started, done_at_start))
+        if chunk:
+            await deliver(chunk)
+        if last_id == window_start:
+            break
+
+    await safe_db_execute("UPDATE broadcast_jobs SET status = 'DONE', updated_at = NOW() WHERE id = %s", (job_id,))
+    await _report(bot, job, _progress_text(job, sent, failed, started, done_at_start, final=True))
+    logger.info(f"✅ Broadcast #{job_id} done: {sent} sent, {failed} failed")
+
+
+async def unfinished_jobs() -> list[int]:
+    """إرجاع معرفات المهام غير المكتملة (بعد انهيار أو إعادة نشر) لاستئنافها"""
+    rows = await safe_db_fetchall("SELECT id FROM broadcast_jobs WHERE status = 'RUNNING' ORDER BY id")
+    return [r["id"] for r in rows]
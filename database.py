@@ -1,8 +1,18 @@
 # database.py — متوافق مع Python 3.13 على Render
 import os
-from psycopg import connect
-from psycopg.rows import dict_row
+import re
+import time
+import random
+import asyncio
 import logging
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from psycopg import AsyncConnection, OperationalError, InterfaceError, sql
+from psycopg.errors import QueryCanceled
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from migrations import apply_migrations
+from metrics import DB_LATENCY, DB_ERRORS
 
 logger = logging.getLogger(__name__)
 
@@ -10,139 +20,256 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("❌ DATABASE_URL is not set!")
 
-_conn = None
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_RETRIES = int(os.getenv("DB_RETRIES", "3"))
+# تجميع إحصاءات كل استعلام في الذاكرة (/dbstats)
+DB_PROFILE = os.getenv("DB_PROFILE", "0") == "1"
+# عتبة تسجيل الاستعلام البطيء بالمللي ثانية
+DB_SLOW_MS = float(os.getenv("DB_SLOW_MS", "200"))
+# نسبة الاستعلامات البطيئة التي يُشغّل عليها EXPLAIN (ANALYZE, BUFFERS)
+DB_EXPLAIN_SAMPLE = float(os.getenv("DB_EXPLAIN_SAMPLE", "0"))
+
+_pool: AsyncConnectionPool | None = None
+_notify_handlers: dict[str, list] = {}
 
-def get_connection():
-    """إرجاع اتصال معاد الاستخدام مع دعم dict row"""
-    global _conn
-    if _conn is None or _conn.closed:
+def _on_reconnect_failed(pool: AsyncConnectionPool):
+    logger.critical("❌ DB pool could not reconnect to the server.")
+
+async def get_pool() -> AsyncConnectionPool:
+    """إرجاع مجمّع الاتصالات (يُفتح عند أول استخدام) مع فحص صحة الاتصال قبل تسليمه"""
+    global _pool
+    if _pool is None:
+        _pool = AsyncConnectionPool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            kwargs={"row_factory": dict_row},
+            check=AsyncConnectionPool.check_connection,
+            reconnect_failed=_on_reconnect_failed,
+            open=False,
+        )
+    if _pool.closed:
         try:
-            _conn = connect(DATABASE_URL, row_factory=dict_row)
-            logger.info("✅ DB connection established.")
+            await _pool.open(wait=True)
+            logger.info(f"✅ DB pool opened (min={DB_POOL_MIN}, max={DB_POOL_MAX}).")
         except Exception as e:
             logger.critical(f"❌ Failed to connect to DB: {e}")
             raise
-    return _conn
+    return _pool
 
-async def safe_db_execute(query: str, params: tuple = None):
-    """تنفيذ استعلام دون إرجاع (INSERT/UPDATE/DELETE) مع دعم إعادة الاتصال"""
-    conn = get_connection()
+async def close_pool():
+    """إغلاق المجمّع عند إيقاف البوت"""
+    global _pool
+    if _pool is not None and not _pool.closed:
+        await _pool.close()
+        logger.info("✅ DB pool closed.")
+    _pool = None
+
+# ---------------- PROFILING ----------------
+@lru_cache(maxsize=1024)
+def fingerprint(query: str) -> str:
+    """توحيد نص الاستعلام: القيم الحرفية والمعاملات تصبح ? والمسافات تُختصر"""
+    q = re.sub(r"'(?:[^']|'')*'", "?", query)
+    q = re.sub(r"%\(\w+\)s|%s", "?", q)
+    q = re.sub(r"\b\d+(?:\.\d+)?\b", "?", q)
+    return re.sub(r"\s+", " ", q).strip()
+
+def _shape(params) -> str:
+    """شكل المعاملات (الأنواع وأطوال المصفوفات) دون قيمها"""
+    def one(v):
+        if isinstance(v, (list, tuple)):
+            return f"{type(v).__name__}[{len(v)}]"
+        if isinstance(v, str):
+            return f"str[{len(v)}]"
+        return type(v).__name__
+    if params is None:
+        return "-"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {one(v)}" for k, v in params.items()) + "}"
+    return "(" + ", ".join(one(v) for v in params) + ")"
+
+
+class QueryStats:
+    __slots__ = ("calls", "errors", "total", "max", "rows")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+
+_profile: dict[str, QueryStats] = {}
+_explain_task: asyncio.Task | None = None
+
+def _record(fp: str, elapsed: float, rows: int, failed: bool):
+    s = _profile.get(fp)
+    if s is None:
+        s = _profile[fp] = QueryStats()
+    s.calls += 1
+    s.errors += failed
+    s.total += elapsed
+    s.max = max(s.max, elapsed)
+    s.rows += max(rows, 0)
+
+async def _explain(query: str, params, fp: str):
+    """EXPLAIN (ANALYZE, BUFFERS) داخل معاملة تُلغى دائمًا حتى لا يبقى أثر للاستعلامات المعدِّلة"""
     try:
-        with conn.cursor() as cur:
-            cur.execute(query, params)
-        conn.commit()
+        pool = await get_pool()
+        async with pool.connection() as conn:
+            async with conn.transaction(force_rollback=True):
+                cur = await conn.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                plan = "\n".join(r["QUERY PLAN"] for r in await cur.fetchall())
+        logger.warning(f"🔍 Plan for {fp[:120]}:\n{plan}")
     except Exception as e:
-        conn.rollback()
-        # محاولة إعادة الاتصال مرة واحدة فقط
-        if hasattr(e, 'pgcode') and e.pgcode == '57P03':  # server shutdown
-            global _conn
-            _conn = None
-            conn = get_connection()
-            with conn.cursor() as cur:
-                cur.execute(query, params)
-            conn.commit()
-        else:
-            logger.error(f"DB execute error: {e}")
+        logger.warning(f"EXPLAIN failed for {fp[:120]}: {e}")
+
+def profile_report(n: int = 10) -> str:
+    """أثقل n استعلامات حسب الزمن الكلي"""
+    top = sorted(_profile.items(), key=lambda kv: -kv[1].total)[:n]
+    lines = []
+    for fp, s in top:
+        lines.append(
+            f"{s.total * 1000:.0f}ms total | {s.calls} calls | avg {s.total / s.calls * 1000:.1f}ms | "
+            f"max {s.max * 1000:.1f}ms | rows {s.rows} | errors {s.errors}\n  {fp[:200]}"
+        )
+    return "\n".join(lines) or "---"
+
+async def _run(query: str, params, fetch: str | None, idempotent: bool = False):
+    """تنفيذ مع قياس الزمن والأخطاء لكل استعلام، وتسجيل البطيء منها عند التفعيل"""
+    global _explain_task
+    fp = fingerprint(query)
+    labels = (f"fetch{fetch}" if fetch else "execute", fp[:80])
+    started, rows, failed = time.perf_counter(), 0, False
+    try:
+        result, rows = await _run_with_retry(query, params, fetch, idempotent)
+        return result
+    except Exception:
+        failed = True
+        DB_ERRORS.inc(*labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        DB_LATENCY.observe(*labels, value=elapsed)
+        if DB_PROFILE:
+            _record(fp, elapsed, rows, failed)
+            if elapsed * 1000 >= DB_SLOW_MS and not failed:
+                logger.warning(f"🐢 Slow query {elapsed * 1000:.0f}ms ({rows} rows): {fp[:200]} params={_shape(params)}")
+                # خطة واحدة في كل مرة حتى لا يضاعف EXPLAIN الحمل وقت الذروة
+                if (_explain_task is None or _explain_task.done()) and random.random() < DB_EXPLAIN_SAMPLE:
+                    _explain_task = asyncio.create_task(_explain(query, params, fp))
+
+async def _run_with_retry(query: str, params, fetch: str | None, idempotent: bool = False):
+    """تنفيذ استعلام على اتصال من المجمّع؛ يُرجع (النتيجة، عدد الصفوف)
+
+    يُعاد فقط ما فشل قبل إرسال الاستعلام (الحصول على الاتصال)، أو ما عُلّم idempotent=True:
+    بعد الإرسال قد يكون الخادم نفّذه وثبّته ثم انقطع الاتصال، فإعادة INSERT تكرره.
+    """
+    pool = await get_pool()
+    for attempt in range(1, DB_RETRIES + 1):
+        sent = False
+        try:
+            async with pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    sent = True
+                    await cur.execute(query, params)
+                    if fetch == "one":
+                        return await cur.fetchone(), cur.rowcount
+                    if fetch == "all":
+                        return await cur.fetchall(), cur.rowcount
+                    return None, cur.rowcount
+        except (PoolTimeout, QueryCanceled):
+            # المجمّع انتظر DB_POOL_TIMEOUT كاملة، أو الخادم ألغى الاستعلام: الإعادة تضاعف الحمل فقط
             raise
+        except (OperationalError, InterfaceError) as e:
+            # الاتصال المعطوب يُستبعد من المجمّع تلقائيًا، فنعيد المحاولة على اتصال جديد
+            if (sent and not idempotent) or attempt == DB_RETRIES:
+                raise
+            logger.warning(f"⚠️ DB connection error (attempt {attempt}/{DB_RETRIES}): {e}")
+            await asyncio.sleep(min(0.2 * 2 ** attempt, 2.0))
+
+async def safe_db_execute(query: str, params: tuple = None, idempotent: bool = False):
+    """تنفيذ استعلام دون إرجاع (INSERT/UPDATE/DELETE) مع دعم إعادة الاتصال"""
+    try:
+        await _run(query, params, None, idempotent)
+    except Exception as e:
+        logger.error(f"DB execute error: {e}")
+        raise
 
-async def safe_db_fetchone(query: str, params: tuple = None):
+async def safe_db_fetchone(query: str, params: tuple = None, idempotent: bool = False):
     """جلب صف واحد بأمان"""
-    conn = get_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute(query, params)
-            return cur.fetchone()
+        return await _run(query, params, "one", idempotent)
     except Exception as e:
         logger.error(f"DB fetchone error: {e}")
         raise
 
-async def safe_db_fetchall(query: str, params: tuple = None):
+async def safe_db_fetchall(query: str, params: tuple = None, idempotent: bool = False):
     """جلب جميع الصفوف بأمان"""
-    conn = get_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute(query, params)
-            return cur.fetchall()
+        return await _run(query, params, "all", idempotent)
     except Exception as e:
         logger.error(f"DB fetchall error: {e}")
         raise
 
-def init_db():
-    """تهيئة الجداول (يُنادى مرة واحدة في البداية)"""
-    conn = get_connection()
+@asynccontextmanager
+async def transaction():
+    """اتصال من المجمّع داخل معاملة واحدة: commit عند النجاح و rollback عند أي خطأ"""
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        yield conn
+
+async def stream(query: str, params=None, itersize: int = 500):
+    """بث الصفوف عبر مؤشر على الخادم (named cursor) دون تحميل النتيجة كاملة في الذاكرة"""
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor(name=f"stream_{id(conn)}") as cur:
+            cur.itersize = itersize
+            await cur.execute(query, params)
+            async for row in cur:
+                yield row
+
+# ---------------- LISTEN / NOTIFY ----------------
+def on_notify(topic: str, callback):
+    """تسجيل دالة تُستدعى عند وصول إشعار بالموضوع المحدد (الحمولة: topic أو topic:arg)"""
+    _notify_handlers.setdefault(topic, []).append(callback)
+
+async def notify_listener(channel: str):
+    """الاستماع الدائم لقناة NOTIFY على اتصال مخصص مع إعادة الاتصال عند الانقطاع"""
+    delay = 1.0
+    while True:
+        try:
+            conn = await AsyncConnection.connect(DATABASE_URL, autocommit=True)
+            async with conn:
+                await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                logger.info(f"✅ Listening on DB channel '{channel}'.")
+                delay = 1.0
+                async for n in conn.notifies():
+                    topic, _, arg = n.payload.partition(":")
+                    for callback in _notify_handlers.get(topic, []):
+                        try:
+                            callback(arg or None)
+                        except Exception as e:
+                            logger.error(f"Notify handler for '{topic}' failed: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ DB listener on '{channel}' lost: {e}. Retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+async def init_db():
+    """تطبيق ترحيلات المخطط المعلقة (يُنادى مرة واحدة في البداية)"""
+    await get_pool()
     try:
-        with conn.cursor() as cur:
-            # users
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    username TEXT,
-                    referrer_id BIGINT,
-                    referral_balance DECIMAL(10,2) DEFAULT 0,
-                    subscription_active BOOLEAN DEFAULT FALSE,
-                    subscription_end DATE,
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
-            """)
-            # settings
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                );
-            """)
-            # defaults
-            defaults = [("subscription_price", "5"), ("referral_reward", "1"), ("min_withdraw", "2")]
-            for k, v in defaults:
-                cur.execute(
-                    "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING;",
-                    (k, v)
-                )
-            # payment_methods
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS payment_methods (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    barcode TEXT NOT NULL
-                );
-            """)
-            # payments
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS payments (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    amount DECIMAL(10,2) NOT NULL,
-                    proof TEXT,
-                    status TEXT DEFAULT 'PENDING',
-                    payment_method_id INTEGER,
-                    transaction_id TEXT,
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
-            """)
-            # withdrawals
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS withdrawals (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    amount DECIMAL(10,2) NOT NULL,
-                    sham_cash_link TEXT,
-                    method TEXT DEFAULT 'sham',
-                    status TEXT DEFAULT 'PENDING',
-                    transaction_id TEXT,
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
-            """)
-            # channel_links
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS channel_links (
-                    id SERIAL PRIMARY KEY,
-                    link TEXT UNIQUE NOT NULL
-                );
-            """)
-        conn.commit()
-        logger.info("✅ Database initialized.")
+        # اتصال مخصص بوضع autocommit لأن CREATE INDEX CONCURRENTLY لا يعمل داخل معاملة
+        async with await AsyncConnection.connect(DATABASE_URL, autocommit=True, row_factory=dict_row) as conn:
+            applied = await apply_migrations(conn)
+        logger.info(f"✅ Database initialized (applied migrations: {applied or 'none'}).")
     except Exception as e:
-        conn.rollback()
         logger.critical(f"❌ init_db failed: {e}")
         raise
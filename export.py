@@ -0,0 +1,152 @@
+# export.py — تصدير users/payments/withdrawals إلى ملف مضغوط يُرسل كمستند (ذاكرة ثابتة مهما كبر الجدول)
+#
+# CSV: COPY (...) TO STDOUT يُبث قطعة قطعة إلى ملف gzip مؤقت (الضغط في خيط منفصل)
+# XLSX (اختياري، يتطلب openpyxl): الصفوف عبر مؤشر على الخادم إلى مصنف write_only
+import os
+import gzip
+import asyncio
+import logging
+import tempfile
+from datetime import date, timedelta
+from telegram import Bot
+from database import transaction, stream
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+logger = logging.getLogger(__name__)
+
+# حد حجم المستند في Bot API الرسمي (يمكن رفعه مع خادم Bot API محلي)
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# %(since)s و %(until)s تاريخان أو NULL؛ until شامل لليوم كله
+_RANGE = "(%(since)s::date IS NULL OR {col} >= %(since)s::date) AND (%(until)s::date IS NULL OR {col} < %(until)s::date)"
+
+EXPORTS = {
+    "users": f"""
+        SELECT u.telegram_id, u.username, u.referrer_id, u.subscription_active, u.subscription_end,
+               COALESCE(b.available, 0) AS balance, COALESCE(b.held, 0) AS held, u.created_at
+        FROM users u LEFT JOIN ledger_balances b ON b.user_id = u.telegram_id
+        WHERE {_RANGE.format(col="u.created_at")}
+        ORDER BY u.id
+    """,
+    "payments": f"""
+        SELECT p.id, p.user_id, p.amount, p.status, m.name AS method, p.transaction_id, p.created_at
+        FROM payments p LEFT JOIN payment_methods m ON m.id = p.payment_method_id
+        WHERE {_RANGE.format(col="p.created_at")}
+        ORDER BY p.id
+    """,
+    "withdrawals": f"""
+        SELECT w.id, w.user_id, w.amount, w.method, w.sham_cash_link, w.status, w.transaction_id, w.created_at
+        FROM withdrawals w
+        WHERE {_RANGE.format(col="w.created_at")}
+        ORDER BY w.id
+    """,
+}
+
+USAGE = (
+    "📤 الاستخدام:\n"
+    "/export users|payments|withdrawals [من] [إلى] [xlsx]\n"
+    "التواريخ بصيغة YYYY-MM-DD (الحدّان شاملان)."
+)
+
+
+def parse_args(args: list[str]):
+    """(kind, since, until, fmt) أو None إن كانت الوسائط غير صالحة"""
+    if not args or args[0] not in EXPORTS:
+        return None
+    kind, rest = args[0], list(args[1:])
+    fmt = "csv"
+    if rest and rest[-1].lower() in ("csv", "xlsx"):
+        fmt = rest.pop().lower()
+    if len(rest) > 2:
+        return None
+    try:
+        dates = [date.fromisoformat(a) for a in rest]
+    except ValueError:
+        return None
+    since = dates[0] if dates else None
+    until = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+    return kind, since, until, fmt
+
+
+CSV_CHUNK = 1024 * 1024
+
+
+async def _write_csv(path: str, query: str, params: dict) -> None:
+    """ضغط gzip متزامن ويحجز المعالج: تُجمع قطع COPY حتى CSV_CHUNK وتُضغط وتُكتب في خيط منفصل"""
+    out = await asyncio.to_thread(gzip.open, path, "wb")
+    try:
+        async with transaction() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params) as copy:
+                    buf = bytearray()
+                    async for chunk in copy:
+                        buf += chunk
+                        if len(buf) >= CSV_CHUNK:
+                            await asyncio.to_thread(out.write, bytes(buf))
+                            buf.clear()
+                    if buf:
+                        await asyncio.to_thread(out.write, bytes(buf))
+    finally:
+        await asyncio.to_thread(out.close)
+
+
+XLSX_BATCH = 2000
+
+
+def _append_rows(ws, rows: list):
+    for row in rows:
+        ws.append(row)
+
+
+async def _write_xlsx(path: str, query: str, params: dict) -> None:
+    """openpyxl متزامن: الإضافة (دفعة دفعة) والحفظ/الضغط في خيط منفصل حتى لا تتوقف حلقة الأحداث"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    batch, header = [], False
+    async for row in stream(query, params, itersize=XLSX_BATCH):
+        if not header:
+            batch.append(list(row))
+            header = True
+        batch.append(list(row.values()))
+        if len(batch) >= XLSX_BATCH:
+            await asyncio.to_thread(_append_rows, ws, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(_append_rows, ws, batch)
+    await asyncio.to_thread(wb.save, path)
+
+
+async def send_export(bot: Bot, chat_id: int, kind: str, since: date | None, until: date | None, fmt: str):
+    """إنشاء الملف وإرساله؛ تُشغَّل في الخلفية وتبلّغ الأدمن بالنتيجة"""
+    if fmt == "xlsx" and Workbook is None:
+        await bot.send_message(chat_id, "❌ تصدير XLSX يتطلب تثبيت openpyxl.")
+        return
+    suffix = ".xlsx" if fmt == "xlsx" else ".csv.gz"
+    fd, path = tempfile.mkstemp(prefix=f"export_{kind}_", suffix=suffix)
+    os.close(fd)
+    params = {"since": since, "until": until}
+    try:
+        if fmt == "xlsx":
+            await _write_xlsx(path, EXPORTS[kind], params)
+        else:
+            await _write_csv(path, EXPORTS[kind], params)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await bot.send_message(chat_id, f"❌ الملف أكبر من الحد ({size // 1024 // 1024}MB). ضيّق نطاق التواريخ.")
+            return
+        stamp = date.today().isoformat()
+        with open(path, "rb") as f:
+            await bot.send_document(
+                chat_id, document=f, filename=f"{kind}_{stamp}{suffix}", caption=f"📤 تصدير {kind}",
+                read_timeout=120, write_timeout=120
+            )
+        logger.info(f"📤 Export {kind} ({fmt}, {size} bytes) sent to {chat_id}")
+    except Exception as e:
+        logger.error(f"Export {kind} failed: {e}")
+        await bot.send_message(chat_id, "❌ فشل التصدير.")
+    finally:
+        os.unlink(path)
@@ -0,0 +1,196 @@
+# fake_telegram.py — أدوات اختبار محلية: خادم Bot API وهمي وعميل يرسل تحديثات إلى الـ webhook
+#
+# تشغيل البوت محليًا بوضع webhook دون الاتصال بـ Telegram:
+#   python fake_telegram.py api --port 8081
+#   BOT_API_URL=http://127.0.0.1:8081 BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 \
+#       WEBHOOK_SECRET=s3cret PORT=8443 python jetoor.py
+#   python fake_telegram.py post --url http://127.0.0.1:8443/telegram --secret s3cret --count 500
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    "id": 1000000001, "is_bot": True, "first_name": "Jetoor", "username": "news_acc_bot",
+    "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+}
+
+
+# ---------------- UPDATE BUILDERS ----------------
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+def _message(message_id: int, user_id: int, **fields) -> dict:
+    return {
+        "message_id": message_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"}, "from": _user(user_id), **fields,
+    }
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    """تحديث رسالة نصية (أو أمر إن بدأ النص بـ /)"""
+    fields = {"text": text}
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": _message(update_id, user_id, **fields)}
+
+def photo_update(update_id: int, user_id: int, file_id: str = "proof-file") -> dict:
+    """تحديث صورة (مثل إشعار الدفع)"""
+    photo = [{"file_id": file_id, "file_unique_id": f"u-{file_id}", "width": 640, "height": 480}]
+    return {"update_id": update_id, "message": _message(update_id, user_id, photo=photo)}
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> dict:
+    """تحديث ضغطة زر inline"""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": _user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": _message(message_id, user_id, text="menu", **{"from": BOT_USER}),
+        },
+    }
+
+
+# ---------------- FAKE BOT API ----------------
+class FakeBotAPI:
+    """خادم Bot API وهمي يرد بنجاح على طلبات البوت ويسجّلها، مع تأخير اختياري لمحاكاة الشبكة"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls: list[tuple[str, dict]] = []
+        self._ids = itertools.count(1)
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"✅ Fake Bot API on {self.url}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    k, _, v = line.decode().partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = path.rstrip("/").rsplit("/", 1)[-1]
+                params = _parse_body(headers.get("content-type", ""), body)
+                self.calls.append((method, params))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status, payload = self.respond(method, params)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, method: str, params: dict) -> tuple[int, dict]:
+        """بناء رد ناجح مناسب لكل طريقة"""
+        chat_id = int(params.get("chat_id") or 1)
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText", "editMessageCaption", "editMessageMedia",
+                        "sendPhoto", "sendDocument"):
+            fields = {"text": params.get("text", "")}
+            if method in ("sendPhoto", "editMessageMedia"):
+                fields = {"photo": [{"file_id": "f", "file_unique_id": "f", "width": 1, "height": 1}]}
+            elif method == "sendDocument":
+                fields = {"document": {"file_id": "d", "file_unique_id": "d"}}
+            result = _message(int(params.get("message_id") or next(self._ids)), chat_id,
+                              **fields, **{"from": BOT_USER})
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+
+def _parse_body(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+    if content_type.startswith("multipart/form-data"):
+        boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+        params = {}
+        for part in body.split(b"--" + boundary):
+            head, _, value = part.partition(b"\r\n\r\n")
+            if b'name="' in head and b"filename=" not in head:
+                name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+                params[name] = value.rstrip(b"\r\n").decode(errors="replace")
+        return params
+    return {}
+
+
+# ---------------- FAKE TELEGRAM CLIENT ----------------
+async def post_updates(url: str, updates: list[dict], secret: str = None, concurrency: int = 10) -> list[int]:
+    """إرسال التحديثات إلى الـ webhook بشكل متزامن كما يفعل Telegram، وإرجاع رموز الاستجابة"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    sem = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def one(payload):
+            async with sem:
+                r = await client.post(url, json=payload, headers=headers)
+                return r.status_code
+        return await asyncio.gather(*(one(u) for u in updates))
+
+
+async def _main(args):
+    if args.cmd == "api":
+        api = FakeBotAPI(args.host, args.port, args.latency)
+        await api.start()
+        await asyncio.Event().wait()
+    else:
+        updates = [message_update(i + 1, 10_000 + i, "/start") for i in range(args.count)]
+        started = time.perf_counter()
+        codes = await post_updates(args.url, updates, args.secret, args.concurrency)
+        elapsed = time.perf_counter() - started
+        print(json.dumps({
+            "sent": len(codes), "ok": codes.count(200), "forbidden": codes.count(403),
+            "seconds": round(elapsed, 3), "updates_per_sec": round(len(codes) / elapsed, 1),
+        }))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local fake Telegram tooling")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_api = sub.add_parser("api", help="run a fake Bot API server")
+    p_api.add_argument("--host", default="127.0.0.1")
+    p_api.add_argument("--port", type=int, default=8081)
+    p_api.add_argument("--latency", type=float, default=0.0)
+    p_post = sub.add_parser("post", help="POST synthetic /start updates to a webhook")
+    p_post.add_argument("--url", required=True)
+    p_post.add_argument("--secret")
+    p_post.add_argument("--count", type=int, default=100)
+    p_post.add_argument("--concurrency", type=int, default=10)
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,73 @@
+# idempotency.py — إسقاط التحديثات المكررة والضغطات المتكررة على أزرار التأكيد من ذاكرة محدودة بمدة صلاحية
+#
+# - update_id: Telegram قد يعيد إرسال التحديث (إعادة محاولة webhook، إعادة تشغيل polling)
+# - (user, action, target, message_id): الضغطة الأولى تنفذ، وما يليها يُجاب بنتيجتها المحفوظة
+# الذاكرة خط الدفاع الأول فقط؛ الكتابات نفسها مشروطة (WHERE status = 'PENDING') فتبقى صحيحة
+# بين النسخ وبعد إعادة التشغيل.
+import os
+import time
+from collections import OrderedDict
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_CACHE = int(os.getenv("IDEMPOTENCY_CACHE", "10000"))
+
+
+class TTLCache:
+    """قاموس LRU محدود الحجم؛ كل المدخلات بنفس المدة فترتيب الإدراج هو ترتيب الانتهاء"""
+
+    def __init__(self, maxsize: int = IDEMPOTENCY_CACHE, ttl: float = IDEMPOTENCY_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def _expire(self, now: float):
+        while self._data:
+            key, (_, expires) = next(iter(self._data.items()))
+            if expires > now:
+                break
+            del self._data[key]
+
+    def get(self, key, default=None):
+        self._expire(time.monotonic())
+        item = self._data.get(key)
+        return default if item is None else item[0]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        self._expire(now)
+        self._data.pop(key, None)
+        self._data[key] = (value, now + self.ttl)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_updates = TTLCache()
+_results = TTLCache()
+
+
+async def drop_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """TypeHandler في أول مجموعة: التحديث المعالج مسبقًا لا يصل لأي معالج"""
+    if update.update_id in _updates:
+        raise ApplicationHandlerStop
+    _updates.set(update.update_id, True)
+
+
+def action_key(update: Update, action: str, target) -> tuple:
+    q = update.callback_query
+    return q.from_user.id, action, target, q.message.message_id if q.message else None
+
+
+def cached_result(key: tuple) -> str | None:
+    return _results.get(key)
+
+
+def remember(key: tuple, result: str):
+    _results.set(key, result)
@@ -1,21 +1,58 @@
 # jetoor.py
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters
+    ApplicationBuilder, CommandHandler,
+    MessageHandler, TypeHandler, ContextTypes, filters
 )
 from telegram.ext import Application
-from database import init_db, safe_db_execute, safe_db_fetchone, safe_db_fetchall
+from database import init_db, close_pool, notify_listener, transaction, safe_db_execute, safe_db_fetchone, safe_db_fetchall
+from database import DB_PROFILE, profile_report
+from settings_cache import settings, DB_NOTIFY_CHANNEL
+import broadcast
+import outbox
+import ledger
+import subscriptions
+import referral_stats
+import metrics
+import export
+import update_queue
+import idempotency
+from update_queue import BOT_ROLE
+from persistence import PostgresPersistence
+from router import CallbackRouter
+from link_pool import link_pool
+from registration import registrations
+from payment_catalog import catalog
+from user_lock import per_user
 from telegram.helpers import escape_markdown
 import logging
 import os
 import asyncio
+import secrets
+import io
+import html
 from typing import Optional
+from functools import lru_cache
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.environ["BOT_TOKEN"]
-ADMINS = [int(x.strip()) for x in os.environ["ADMINS"].split(",") if x.strip()]
-BATCH_SIZE = 30
+ADMINS = frozenset(int(x.strip()) for x in os.environ["ADMINS"].split(",") if x.strip())
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "5"))
+PAYMENT_PREFETCH = int(os.getenv("PAYMENT_PREFETCH", "5"))
+# عدد التحديثات المعالجة بالتوازي (تحديثات المستخدم الواحد تبقى متسلسلة عبر user_lock)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+# وضع الاستقبال: polling (الافتراضي) أو webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8443"))
+# حفظ حالة المحادثة في القاعدة (تبقى بعد إعادة التشغيل)
+PERSIST_STATE = os.getenv("PERSIST_STATE", "1") == "1"
+# عنوان Bot API بديل (مثلًا خادم وهمي محلي للاختبار)
+BOT_API_URL = os.getenv("BOT_API_URL")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -37,17 +74,6 @@ STATE_EDIT_SETTING = "admin:edit:"
 STATE_EDIT_PM = "admin:edit_pm:"
 
 # ---------------- UTILS ----------------
-def parse_callback(data: str):
-    try:
-        parts = data.split(":", 2)
-        action = parts[0]
-        id_val = parts[1] if len(parts) > 1 else None
-        extra = parts[2] if len(parts) > 2 else None
-        return action, id_val, extra
-    except:
-        return None, None, None
-
-
 def clean_user_data(context, keys=None):
     if keys:
         for k in keys:
@@ -55,6 +81,7 @@ def clean_user_data(context, keys=None):
     else:
         context.user_data.clear()
 
+@lru_cache(maxsize=512)
 def confirm_menu(yes="✅ نعم", no="❌ لا", yes_data="confirm:yes", no_data="cancel:op"):
     return InlineKeyboardMarkup([[InlineKeyboardButton(yes, callback_data=yes_data),
                                    InlineKeyboardButton(no, callback_data=no_data)]])
@@ -64,27 +91,34 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Exception: {context.error}", exc_info=True)
 
 # ---------------- MENUS ----------------
+# لوحات ثابتة تُبنى مرة واحدة (InlineKeyboardMarkup غير قابل للتعديل فيمكن مشاركته)
+USER_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📌 الاشتراك", callback_data="menu:subscribe")],
+    [InlineKeyboardButton("💰 الإحالة", callback_data="menu:referral")],
+    [InlineKeyboardButton("📊 رصيدي", callback_data="menu:balance")],
+    [InlineKeyboardButton("📤 سحب الأرباح", callback_data="menu:withdraw")],
+    [InlineKeyboardButton("🛠️ الدعم", callback_data="menu:support")]
+])
+
+ADMIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🧾 طلبات الاشتراك", callback_data="admin:payments")],
+    [InlineKeyboardButton("💸 طلبات السحب", callback_data="admin:withdraws")],
+    [InlineKeyboardButton("⚙️ الإعدادات", callback_data="admin:settings")],
+    [InlineKeyboardButton("💳 طرق الدفع", callback_data="admin:payment_methods")],
+    [InlineKeyboardButton("🔗 روابط القناة", callback_data="admin:channel_links")],
+    [InlineKeyboardButton("📢 رسالة جماعية", callback_data="admin:broadcast")],
+    [InlineKeyboardButton("📨 رسالة لمستخدم", callback_data="admin:send_to_user")],
+    [InlineKeyboardButton("📈 إحصاءات الإحالة", callback_data="admin:referrals")]
+])
+
 def user_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📌 الاشتراك", callback_data="menu:subscribe")],
-        [InlineKeyboardButton("💰 الإحالة", callback_data="menu:referral")],
-        [InlineKeyboardButton("📊 رصيدي", callback_data="menu:balance")],
-        [InlineKeyboardButton("📤 سحب الأرباح", callback_data="menu:withdraw")],
-        [InlineKeyboardButton("🛠️ الدعم", callback_data="menu:support")]
-    ])
+    return USER_MENU
 
 def admin_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🧾 طلبات الاشتراك", callback_data="admin:payments")],
-        [InlineKeyboardButton("💸 طلبات السحب", callback_data="admin:withdraws")],
-        [InlineKeyboardButton("⚙️ الإعدادات", callback_data="admin:settings")],
-        [InlineKeyboardButton("💳 طرق الدفع", callback_data="admin:payment_methods")],
-        [InlineKeyboardButton("🔗 روابط القناة", callback_data="admin:channel_links")],
-        [InlineKeyboardButton("📢 رسالة جماعية", callback_data="admin:broadcast")],
-        [InlineKeyboardButton("📨 رسالة لمستخدم", callback_data="admin:send_to_user")]
-    ])
+    return ADMIN_MENU
 
 # ---------------- START ----------------
+@per_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     args = context.args
@@ -92,174 +126,265 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if ref == user.id:
         ref = None
 
-    await safe_db_execute("""
-        INSERT INTO users (telegram_id, username, referrer_id)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (telegram_id) DO NOTHING
-    """, (user.id, user.username, ref))
+    # التسجيل يُجمع ويُكتب دفعة واحدة في الخلفية؛ الرد لا ينتظر القاعدة
+    registrations.register(user.id, user.username, ref)
 
-    price_row = await safe_db_fetchone("SELECT value FROM settings WHERE key = 'subscription_price'")
-    price = price_row["value"] if price_row else "5"
+    price = await settings.get("subscription_price")
+    days = await settings.get_int("subscription_days")
     await update.message.reply_text(
         f"🔐 مرحبًا بك في بوت الاشتراك في قناة الأخبار العاجلة\n\n"
         f"📌 اشترك الآن للوصول إلى المحتوى الحصري\n"
         f"💰 اربح عبر رابط الإحالة بعد تفعيل اشتراكك\n\n"
         f"💳 رسوم الاشتراك: **{price}$ أمريكي**\n"
-        f"🗓️ المدة: حتى **31 ديسمبر 2026**",
+        f"🗓️ المدة: **{days} يومًا**",
         parse_mode="HTML",
         reply_markup=user_menu()
     )
 
+# ---------------- ADMIN PAGES ----------------
+async def withdrawals_page(direction: str, cursor: int):
+    """صفحة من طلبات السحب المعلقة (ترقيم keyset على withdrawals.id) مع الرصيد باستعلام واحد"""
+    if direction == "prev":
+        rows = await safe_db_fetchall("""
+            SELECT w.id, w.user_id, w.amount, w.sham_cash_link, w.method,
+                   COALESCE(b.available, 0) AS balance
+            FROM withdrawals w LEFT JOIN ledger_balances b ON b.user_id = w.user_id
+            WHERE w.status = 'PENDING' AND w.id < %s
+            ORDER BY w.id DESC LIMIT %s
+        """, (cursor, ADMIN_PAGE_SIZE + 1))
+        has_prev, has_next = len(rows) > ADMIN_PAGE_SIZE, True
+        rows = list(reversed(rows[:ADMIN_PAGE_SIZE]))
+    else:
+        rows = await safe_db_fetchall("""
+            SELECT w.id, w.user_id, w.amount, w.sham_cash_link, w.method,
+                   COALESCE(b.available, 0) AS balance
+            FROM withdrawals w LEFT JOIN ledger_balances b ON b.user_id = w.user_id
+            WHERE w.status = 'PENDING' AND w.id > %s
+            ORDER BY w.id LIMIT %s
+        """, (cursor, ADMIN_PAGE_SIZE + 1))
+        has_prev, has_next = cursor > 0, len(rows) > ADMIN_PAGE_SIZE
+        rows = rows[:ADMIN_PAGE_SIZE]
+    if not rows:
+        return None
+
+    blocks, buttons = [], []
+    for r in rows:
+        method = "شام كاش" if r["method"] == "sham" else "USDT (BEP20)"
+        blocks.append(
+            f"💸 طلب سحب #{r['id']}\n"
+            f"👤 المستخدم: {r['user_id']}\n"
+            f"💵 المبلغ: {r['amount']}$\n"
+            f"📊 رصيده الحالي: {r['balance']}$\n"
+            f"📌 الطريقة: {method}\n"
+            f"📋 البيانات: `{ r['sham_cash_link'] or '---' }`"
+        )
+        buttons.append([
+            InlineKeyboardButton(f"✅ #{r['id']}", callback_data=f"pay:{r['id']}"),
+            InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_w:{r['id']}"),
+            InlineKeyboardButton("ℹ️ استعلام", callback_data=f"inquiry:{r['user_id']}")
+        ])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"wpage:prev:{rows[0]['id']}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"wpage:next:{rows[-1]['id']}"))
+    if nav:
+        buttons.append(nav)
+    return "\n\n".join(blocks), InlineKeyboardMarkup(buttons)
+
+# طابور مراجعة الدفعات: الصفحة التالية تُجلب في الخلفية لكل أدمن
+_payment_prefetch: dict[int, list] = {}
+
+PENDING_PAYMENTS_SQL = """
+    SELECT id, user_id, amount, proof FROM payments
+    WHERE status = 'PENDING' AND id > %s
+    ORDER BY id LIMIT %s
+"""
+
+async def _prefetch_payments(admin_id: int, after_id: int):
+    try:
+        _payment_prefetch[admin_id] = await safe_db_fetchall(PENDING_PAYMENTS_SQL, (after_id, PAYMENT_PREFETCH))
+    except Exception as e:
+        logger.warning(f"Payment prefetch failed: {e}")
+
+def forget_payment(pid: int):
+    """إزالة طلب عولج من صفحات الجلب المسبق لدى جميع الأدمن"""
+    for admin_id, rows in _payment_prefetch.items():
+        _payment_prefetch[admin_id] = [r for r in rows if r["id"] != pid]
+
+async def next_pending_payment(context: ContextTypes.DEFAULT_TYPE, admin_id: int, after_id: int):
+    """أول طلب اشتراك معلق بعد after_id (ترقيم keyset) من الصفحة المجلوبة مسبقًا إن وُجدت"""
+    rows = [r for r in _payment_prefetch.pop(admin_id, []) if r["id"] > after_id]
+    if not rows:
+        rows = await safe_db_fetchall(PENDING_PAYMENTS_SQL, (after_id, PAYMENT_PREFETCH))
+    if not rows:
+        return None
+    row = rows[0]
+    _payment_prefetch[admin_id] = rows[1:]
+    context.application.create_task(_prefetch_payments(admin_id, row["id"]))
+    return row
+
+def payment_caption(row) -> str:
+    return f"🧾 اشتراك #{row['id']}\n👤 {row['user_id']}\n💵 {row['amount']}$"
+
+def payment_review_markup(row) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅", callback_data=f"approve:{row['id']}"),
+         InlineKeyboardButton("❌", callback_data=f"reject:{row['id']}")],
+        [InlineKeyboardButton("⏭️ التالي", callback_data=f"pq:next:{row['id']}")]
+    ])
+
 # ---------------- CALLBACKS ----------------
-async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    action, id_val, extra = parse_callback(q.data)
-    if not action:
-        await q.message.reply_text("❌ طلب غير صالح.")
-        return
+router = CallbackRouter(ADMINS)
 
+# ---------- USER ----------
+@router.route("menu")
+async def menu_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
     uid = q.from_user.id
-
-    # ---------- USER ----------
-    if action == "menu":
-        if id_val == "subscribe":
-            rows = await safe_db_fetchall("SELECT id, name, barcode FROM payment_methods")
-            if not rows:
-                await q.message.reply_text("💳 لا توجد طرق دفع متاحة. تواصل مع الدعم.")
-                return
-            buttons = [[InlineKeyboardButton(r["name"], callback_data=f"paymethod:{r['id']}")] for r in rows]
-            await q.message.reply_text("💳 اختر طريقة الدفع:", reply_markup=InlineKeyboardMarkup(buttons))
-        
-        elif id_val == "referral":
-            row = await safe_db_fetchone(
-                "SELECT subscription_active FROM users WHERE telegram_id = %s", (uid,)
-            )
-            active = row["subscription_active"] if row else 0
-            if active != 1:
-                await q.message.reply_text("❌ يجب أن تكون مشتركًا لتفعيل رابط الإحالة.")
-                return
-            reward = (await safe_db_fetchone(
-                "SELECT value FROM settings WHERE key = 'referral_reward'"
-            ))["value"]
-            # ✅ رابط صحيح بدون مسافات
-            link = f"https://t.me/news_acc_bot?start={uid}"
+    if id_val == "subscribe":
+        snap = await catalog.current()
+        if not snap.user_keyboard:
+            await q.message.reply_text("💳 لا توجد طرق دفع متاحة. تواصل مع الدعم.")
+            return
+        await q.message.reply_text("💳 اختر طريقة الدفع:", reply_markup=snap.user_keyboard)
+    
+    elif id_val == "referral":
+        row = await safe_db_fetchone(
+            "SELECT subscription_active FROM users WHERE telegram_id = %s", (uid,)
+        )
+        active = row["subscription_active"] if row else 0
+        if active != 1:
+            await q.message.reply_text("❌ يجب أن تكون مشتركًا لتفعيل رابط الإحالة.")
+            return
+        reward = await settings.get("referral_reward")
+        # ✅ رابط صحيح بدون مسافات
+        link = f"https://t.me/news_acc_bot?start={uid}"
+        await q.message.reply_text(
+            f"🔗 رابطك:\n{link}\n💰 العمولة: {reward}$",
+            disable_web_page_preview=True,
+            parse_mode="HTML"
+        )
+    
+    elif id_val == "balance":
+        bal, held = await ledger.balance(uid)
+        text = f"💵 رصيدك: {bal}$"
+        if held:
+            text += f"\n⏳ محجوز لطلب سحب: {held}$"
+        await q.message.reply_text(text, parse_mode="HTML")
+    
+    elif id_val == "withdraw":
+        available, _ = await ledger.balance(uid)
+        bal = float(available)
+        min_w = await settings.get_float("min_withdraw")
+        if bal < min_w:
             await q.message.reply_text(
-                f"🔗 رابطك:\n{link}\n💰 العمولة: {reward}$",
-                disable_web_page_preview=True,
+                f"❌ الحد الأدنى للسحب هو {min_w}$. رصيدك: {bal}$.",
                 parse_mode="HTML"
             )
-        
-        elif id_val == "balance":
-            row = await safe_db_fetchone(
-                "SELECT referral_balance FROM users WHERE telegram_id = %s", (uid,)
-            )
-            bal = row["referral_balance"] if row else 0
-            await q.message.reply_text(f"💵 رصيدك: {bal}$", parse_mode="HTML")
-        
-        elif id_val == "withdraw":
-            row = await safe_db_fetchone(
-                "SELECT referral_balance FROM users WHERE telegram_id = %s", (uid,)
-            )
-            bal = float(row["referral_balance"]) if row else 0.0
-            min_w = float((await safe_db_fetchone(
-                "SELECT value FROM settings WHERE key = 'min_withdraw'"
-            ))["value"])
-            if bal < min_w:
-                await q.message.reply_text(
-                    f"❌ الحد الأدنى للسحب هو {min_w}$. رصيدك: {bal}$.",
-                    parse_mode="HTML"
-                )
-            else:
-                context.user_data.update({
-                    "state": STATE_WITHDRAW_METHOD,
-                    "amount": bal
-                })
-                await q.message.reply_text(
-                    f"💰 رصيدك جاهز للسحب: {bal}$nnاختر طريقة الاستلام:",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("شام كاش", callback_data="withdraw:sham")],
-                        [InlineKeyboardButton("USDT (BEP20)", callback_data="withdraw:usdt")],
-                        [InlineKeyboardButton("إلغاء", callback_data="cancel:op")]
-                    ])
-                )
-        
-        elif id_val == "support":
-            context.user_data["state"] = STATE_SUPPORT
-            await q.message.reply_text("✉️ اكتب رسالتك:")
-
-    elif action == "paymethod":
-        try:
-            method_id = int(id_val)
+        else:
             context.user_data.update({
-                "state": STATE_AWAITING_PAYMENT,
-                "payment_method_id": method_id
+                "state": STATE_WITHDRAW_METHOD,
+                "amount": bal
             })
-            row = await safe_db_fetchone(
-                "SELECT name, barcode FROM payment_methods WHERE id = %s", (method_id,)
-            )
-            if not row:
-                await q.message.reply_text("❌ طريقة دفع غير موجودة.")
-                return
-            name = row["name"]
-            barcode = row["barcode"]
             await q.message.reply_text(
-                f"💵 أرسل **صورة إشعار الدفع** (لقطة من تطبيق الدفع)\n"
-                f"📱 الطريقة: *{ name }*\n"
-                f"📎 الرابط: `{ barcode }`",
-                parse_mode="HTML"
+                f"💰 رصيدك جاهز للسحب: {bal}$nnاختر طريقة الاستلام:",
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("شام كاش", callback_data="withdraw:sham")],
+                    [InlineKeyboardButton("USDT (BEP20)", callback_data="withdraw:usdt")],
+                    [InlineKeyboardButton("إلغاء", callback_data="cancel:op")]
+                ])
             )
-        except (ValueError, TypeError):
-            await q.message.reply_text("❌ معرّف غير صالح.")
+    
+    elif id_val == "support":
+        context.user_data["state"] = STATE_SUPPORT
+        await q.message.reply_text("✉️ اكتب رسالتك:")
 
-    elif action == "withdraw":
+@router.route("paymethod")
+async def paymethod_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        method_id = int(id_val)
         context.user_data.update({
-            "state": STATE_WITHDRAW_DATA,
-            "withdraw_method": id_val  # sham أو usdt
+            "state": STATE_AWAITING_PAYMENT,
+            "payment_method_id": method_id
         })
-        msg = "كود شام كاش:" if id_val == "sham" else "محفظة USDT (BEP20):"
-        await q.message.reply_text(f"🔢 {msg}", parse_mode="HTML")
-
-    elif action == "confirm" and id_val == "withdraw":
-        wd = context.user_data.pop("temp_withdraw", None)
-        if not wd:
-            await q.message.edit_text("❌ بيانات مفقودة أو منتهية.", parse_mode="HTML")
+        row = (await catalog.current()).methods.get(method_id)
+        if not row:
+            await q.message.reply_text("❌ طريقة دفع غير موجودة.")
             return
-        try:
-            row = await safe_db_fetchone("""
-                INSERT INTO withdrawals (user_id, amount, sham_cash_link, method, status)
-                VALUES (%s, %s, %s, %s, 'PENDING')
-                RETURNING id
-            """, (uid, wd["amount"], wd["data"], wd["method"]))
-            wid = row["id"]
-            clean_user_data(context, ["temp_withdraw"])
-            await q.message.edit_text(f"✅ تم إرسال طلب السحب #{wid} للأدمن.", parse_mode="HTML")
-            # إشعار الأدمن
-            method_text = "شام كاش" if wd["method"] == "sham" else "USDT (BEP20)"
-            for admin in ADMINS:
-                try:
-                    await context.bot.send_message(
-                        admin,
-                        f"💸 طلب سحب جديد #{wid}\n"
-                        f"👤 المستخدم: {uid}\n"
-                        f"💵 المبلغ: {wd['amount']}$\n"
-                        f"📌 الطريقة: {method_text}\n"
-                        f"📋 البيانات: `{ wd['data'] }`",
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("✅ تأكيد", callback_data=f"pay:{wid}")],
-                            [InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_w:{wid}")],
-                            [InlineKeyboardButton("ℹ️ استعلام", callback_data=f"inquiry:{uid}")]
-                        ])
-                    )
-                except Exception as e:
-                    logger.warning(f"Failed to notify admin {admin}: {e}")
-        except Exception as e:
-            logger.error(f"Withdraw insert failed: {e}")
-            await q.message.edit_text("❌ خطأ في معالجة الطلب.", parse_mode="HTML")
+        name = row["name"]
+        barcode = row["barcode"]
+        await q.message.reply_text(
+            f"💵 أرسل **صورة إشعار الدفع** (لقطة من تطبيق الدفع)\n"
+            f"📱 الطريقة: *{ name }*\n"
+            f"📎 الرابط: `{ barcode }`",
+            parse_mode="HTML"
+        )
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
+
+@router.route("withdraw")
+async def withdraw_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    context.user_data.update({
+        "state": STATE_WITHDRAW_DATA,
+        "withdraw_method": id_val  # sham أو usdt
+    })
+    msg = "كود شام كاش:" if id_val == "sham" else "محفظة USDT (BEP20):"
+    await q.message.reply_text(f"🔢 {msg}", parse_mode="HTML")
 
-    elif action == "edit" and id_val == "withdraw_data":
+@router.route("confirm", idempotent=True)
+async def confirm_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    uid = q.from_user.id
+    if id_val != "withdraw":
+        return
+    wd = context.user_data.pop("temp_withdraw", None)
+    if not wd:
+        await q.message.edit_text("❌ بيانات مفقودة أو منتهية.", parse_mode="HTML")
+        return
+    try:
+        method_text = "شام كاش" if wd["method"] == "sham" else "USDT (BEP20)"
+        # الطلب وإشعارات الأدمن في معاملة واحدة: لا طلب بلا إشعار ولا إشعار بلا طلب
+        async with transaction() as conn:
+            # حجز المبلغ في الدفتر مع إنشاء الطلب؛ الأرباح اللاحقة تبقى في المتاح ولا يمسها الصرف
+            wid = await ledger.hold(conn, uid, wd["amount"], wd["data"], wd["method"])
+            if wid is None:
+                text = "❌ الرصيد غير كافٍ أو لديك طلب سحب معلق."
+                await q.message.edit_text(text, parse_mode="HTML")
+                return text
+            markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ تأكيد", callback_data=f"pay:{wid}")],
+                [InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_w:{wid}")],
+                [InlineKeyboardButton("ℹ️ استعلام", callback_data=f"inquiry:{uid}")]
+            ])
+            await outbox.enqueue([
+                outbox.message(
+                    admin,
+                    f"💸 طلب سحب جديد #{wid}\n"
+                    f"👤 المستخدم: {uid}\n"
+                    f"💵 المبلغ: {wd['amount']}$\n"
+                    f"📌 الطريقة: {method_text}\n"
+                    f"📋 البيانات: `{ wd['data'] }`",
+                    reply_markup=markup
+                )
+                for admin in ADMINS
+            ], conn)
+        outbox.wake()
+        clean_user_data(context, ["temp_withdraw"])
+        text = f"✅ تم إرسال طلب السحب #{wid} للأدمن."
+        await q.message.edit_text(text, parse_mode="HTML")
+        return text
+    except Exception as e:
+        logger.error(f"Withdraw insert failed: {e}")
+        await q.message.edit_text("❌ خطأ في معالجة الطلب.", parse_mode="HTML")
+
+@router.route("edit")
+async def edit_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    if id_val == "withdraw_data":
         method = context.user_data.get("withdraw_method_temp", "sham")
         bal = context.user_data.get("withdraw_amount", 0)
         msg = "أعد إدخال كود شام كاش:" if method == "sham" else "أعد إدخال محفظة USDT (BEP20):"
@@ -267,244 +392,379 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["withdraw_method"] = method
         context.user_data.pop("withdraw_data_temp", None)
         await q.message.edit_text(f"{msg}\n💵 المبلغ: {bal}$", parse_mode="HTML")
-
-    elif action == "cancel":
-        clean_user_data(context)
-        await q.message.reply_text("❌ تم الإلغاء.", parse_mode="HTML")
-
-    # ---------- ADMIN ----------
-    if uid not in ADMINS:
         return
+    # تعديل الإعدادات (أدمن فقط)
+    if q.from_user.id not in ADMINS:
+        return
+    key_map = {"price": "subscription_price", "ref": "referral_reward", "min": "min_withdraw", "days": "subscription_days"}
+    key = key_map.get(id_val)
+    if key:
+        context.user_data["state"] = STATE_EDIT_SETTING + key
+        await q.message.reply_text(f"أدخل القيمة الجديدة لـ '{id_val}':")
 
-    if action == "admin":
-        if id_val == "payments":
-            rows = await safe_db_fetchall(
-                "SELECT id, user_id, amount, proof FROM payments WHERE status = 'PENDING'"
-            )
-            if not rows:
-                await q.message.reply_text("📭 لا توجد طلبات.", parse_mode="HTML")
-                return
-            for r in rows:
-                try:
-                    await context.bot.send_photo(
-                        uid, photo=r["proof"],
-                        caption=f"🧾 اشتراك #{r['id']}\n👤 {r['user_id']}\n💵 {r['amount']}$",
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("✅", callback_data=f"approve:{r['id']}"),
-                             InlineKeyboardButton("❌", callback_data=f"reject:{r['id']}")]
-                        ])
-                    )
-                except Exception as e:
-                    logger.warning(f"Photo send failed: {e}")
-        
-        elif id_val == "withdraws":
-            rows = await safe_db_fetchall("""
-                SELECT id, user_id, amount, sham_cash_link, method
-                FROM withdrawals WHERE status = 'PENDING'
-            """)
-            if not rows:
-                await q.message.reply_text("📭 لا توجد طلبات سحب.", parse_mode="HTML")
-                return
-            for r in rows:
-                bal_row = await safe_db_fetchone(
-                    "SELECT referral_balance FROM users WHERE telegram_id = %s", (r["user_id"],)
-                )
-                bal = bal_row["referral_balance"] if bal_row else 0
-                method = "شام كاش" if r["method"] == "sham" else "USDT (BEP20)"
-                await q.message.reply_text(
-                    f"💸 طلب سحب #{r['id']}\n"
-                    f"👤 المستخدم: {r['user_id']}\n"
-                    f"💵 المبلغ: {r['amount']}$\n"
-                    f"📊 رصيده الحالي: {bal}$\n"
-                    f"📌 الطريقة: {method}\n"
-                    f"📋 البيانات: `{ r['sham_cash_link'] or '---' }`",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ تأكيد", callback_data=f"pay:{r['id']}"),
-                         InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_w:{r['id']}"),
-                         InlineKeyboardButton("ℹ️ استعلام", callback_data=f"inquiry:{r['user_id']}")]
-                    ])
-                )
-        
-        elif id_val == "settings":
-            p = (await safe_db_fetchone("SELECT value FROM settings WHERE key = 'subscription_price'"))["value"]
-            r = (await safe_db_fetchone("SELECT value FROM settings WHERE key = 'referral_reward'"))["value"]
-            m = (await safe_db_fetchone("SELECT value FROM settings WHERE key = 'min_withdraw'"))["value"]
-            await q.message.reply_text(
-                f"⚙️ الإعدادات:\n- السعر: {p}$\n- العمولة: {r}$\n- الحد الأدنى: {m}$",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✏️ سعر", callback_data="edit:price")],
-                    [InlineKeyboardButton("✏️ عمولة", callback_data="edit:ref")],
-                    [InlineKeyboardButton("✏️ حد السحب", callback_data="edit:min")]
-                ])
-            )
-        
-        elif id_val == "payment_methods":
-            rows = await safe_db_fetchall("SELECT id, name FROM payment_methods")
-            buttons = [[InlineKeyboardButton("➕ إضافة طريقة دفع", callback_data="add_payment:new")]]
-            for r in rows:
-                buttons.append([
-                    InlineKeyboardButton("✏️ تعديل", callback_data=f"edit_pm:{r['id']}"),
-                    InlineKeyboardButton("🗑️ حذف", callback_data=f"del_pm:{r['id']}")
-                ])
-                buttons.append([InlineKeyboardButton(f"💳 {r['name']}", callback_data="cancel:op")])
-            buttons.append([InlineKeyboardButton("🔙 رجوع", callback_data="cancel:op")])
-            await q.message.reply_text(
-                "💳 طرق الدفع المتوفرة:" if rows else "💳 لا توجد طرق دفع مُضافة بعد.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-        
-        elif id_val == "channel_links":
-            rows = await safe_db_fetchall("SELECT id, link FROM channel_links")
-            buttons = [[InlineKeyboardButton("➕ إضافة روابط", callback_data="add_links:bulk")]]
-            for r in rows:
-                short = (r["link"][:25] + "…") if len(r["link"]) > 25 else r["link"]
-                buttons.append([InlineKeyboardButton(f"🗑️ { short }", callback_data=f"del_link:{r['id']}")])
-            buttons.append([InlineKeyboardButton("🔙", callback_data="cancel:op")])
-            await q.message.reply_text("🔗 روابط القناة:", reply_markup=InlineKeyboardMarkup(buttons))
-        
-        elif id_val == "broadcast":
-            context.user_data["state"] = STATE_BROADCAST
-            await q.message.reply_text("📢 أرسل الرسالة الجماعية:")
-        
-        elif id_val == "send_to_user":
-            context.user_data["state"] = STATE_AWAITING_USER_ID
-            await q.message.reply_text("👤 أرسل معرف المستخدم (ID):", parse_mode="HTML")
-
-    elif action == "approve":
-        try:
-            pid = int(id_val)
-            context.user_data.update({
-                "state": STATE_APPROVE_PID,
-                "approve_pid": pid
-            })
-            await q.message.reply_text("🔢 أدخل رقم العملية:")
-        except (ValueError, TypeError):
-            await q.message.reply_text("❌ معرّف غير صالح.")
-
-    elif action == "reject":
-        await q.message.reply_text("⚠️ تأكيد الرفض؟", reply_markup=confirm_menu("✅", "❌", f"confirm_reject:{id_val}", "cancel:op"))
+@router.route("cancel")
+async def cancel_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    clean_user_data(context)
+    await update.callback_query.message.reply_text("❌ تم الإلغاء.", parse_mode="HTML")
 
-    elif action == "confirm_reject":
-        try:
-            pid = int(id_val)
-            await safe_db_execute("UPDATE payments SET status = 'REJECTED' WHERE id = %s", (pid,))
-            await q.message.reply_text("❌ تم الرفض.", parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Reject failed: {e}")
-            await q.message.reply_text("❌ خطأ في المعالجة.")
+# ---------- ADMIN ----------
+@router.route("admin", admin=True)
+async def admin_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    uid = q.from_user.id
+    if id_val == "payments":
+        row = await next_pending_payment(context, uid, 0)
+        if not row:
+            await q.message.reply_text("📭 لا توجد طلبات.", parse_mode="HTML")
+            return
+        await context.bot.send_photo(
+            uid, photo=row["proof"], caption=payment_caption(row),
+            parse_mode="HTML", reply_markup=payment_review_markup(row)
+        )
+    
+    elif id_val == "withdraws":
+        page = await withdrawals_page("next", 0)
+        if not page:
+            await q.message.reply_text("📭 لا توجد طلبات سحب.", parse_mode="HTML")
+            return
+        text, markup = page
+        await q.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+    
+    elif id_val == "settings":
+        values = await settings.all()
+        p, r, m = values["subscription_price"], values["referral_reward"], values["min_withdraw"]
+        d = values["subscription_days"]
+        await q.message.reply_text(
+            f"⚙️ الإعدادات:\n- السعر: {p}$\n- العمولة: {r}$\n- الحد الأدنى: {m}$\n- مدة الاشتراك: {d} يومًا",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✏️ سعر", callback_data="edit:price")],
+                [InlineKeyboardButton("✏️ عمولة", callback_data="edit:ref")],
+                [InlineKeyboardButton("✏️ حد السحب", callback_data="edit:min")],
+                [InlineKeyboardButton("✏️ مدة الاشتراك", callback_data="edit:days")]
+            ])
+        )
+    
+    elif id_val == "payment_methods":
+        snap = await catalog.current()
+        await q.message.reply_text(
+            "💳 طرق الدفع المتوفرة:" if snap.methods else "💳 لا توجد طرق دفع مُضافة بعد.",
+            parse_mode="HTML",
+            reply_markup=snap.admin_keyboard
+        )
+    
+    elif id_val == "channel_links":
+        rows = await safe_db_fetchall("SELECT id, link FROM channel_links")
+        buttons = [[InlineKeyboardButton("➕ إضافة روابط", callback_data="add_links:bulk")]]
+        for r in rows:
+            short = (r["link"][:25] + "…") if len(r["link"]) > 25 else r["link"]
+            buttons.append([InlineKeyboardButton(f"🗑️ { short }", callback_data=f"del_link:{r['id']}")])
+        buttons.append([InlineKeyboardButton("🔙", callback_data="cancel:op")])
+        await q.message.reply_text(f"🔗 روابط القناة ({len(rows)}):", reply_markup=InlineKeyboardMarkup(buttons))
+    
+    elif id_val == "broadcast":
+        context.user_data["state"] = STATE_BROADCAST
+        await q.message.reply_text("📢 أرسل الرسالة الجماعية:")
+    
+    elif id_val == "send_to_user":
+        context.user_data["state"] = STATE_AWAITING_USER_ID
+        await q.message.reply_text("👤 أرسل معرف المستخدم (ID):", parse_mode="HTML")
 
-    elif action == "pay":
-        try:
-            wid = int(id_val)
-            context.user_data.update({
-                "state": STATE_PAY_WID,
-                "pay_wid": wid
-            })
-            await q.message.reply_text("🔢 أدخل رقم العملية:")
-        except (ValueError, TypeError):
-            await q.message.reply_text("❌ معرّف غير صالح.")
+    elif id_val == "referrals":
+        await q.message.reply_text(await referral_stats.leaderboard_text())
 
-    elif action == "cancel_w":
-        await q.message.reply_text("⚠️ تأكيد إلغاء طلب السحب؟", reply_markup=confirm_menu("✅", "❌", f"confirm_cancel_w:{id_val}", "cancel:op"))
+@router.route("wpage", admin=True)
+async def wpage_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        page = await withdrawals_page(id_val, int(extra))
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
+        return
+    if not page:
+        await q.message.edit_text("📭 لا توجد طلبات سحب.", parse_mode="HTML")
+        return
+    text, markup = page
+    await q.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
 
-    elif action == "confirm_cancel_w":
-        try:
-            wid = int(id_val)
-            row = await safe_db_fetchone("SELECT user_id FROM withdrawals WHERE id = %s", (wid,))
-            if not row:
-                await q.message.reply_text("❌ الطلب غير موجود.")
-                return
-            u = row["user_id"]
-            await safe_db_execute("UPDATE withdrawals SET status = 'CANCELLED' WHERE id = %s", (wid,))
-            try:
-                await context.bot.send_message(
-                    u,
-                    "❌ تم إلغاء طلب سحب أرباحك. تواصل مع الدعم للمزيد.",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-            await q.message.reply_text("✅ تم الإلغاء.", parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Cancel withdrawal failed: {e}")
-            await q.message.reply_text("❌ خطأ في المعالجة.")
+@router.route("pq", admin=True)
+async def pq_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    if id_val != "next":
+        return
+    try:
+        row = await next_pending_payment(context, q.from_user.id, int(extra))
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
+        return
+    if not row:
+        await q.message.edit_caption("📭 انتهت الطلبات المعلقة.", parse_mode="HTML")
+        return
+    await q.message.edit_media(
+        InputMediaPhoto(row["proof"], caption=payment_caption(row), parse_mode="HTML"),
+        reply_markup=payment_review_markup(row)
+    )
 
-    elif action == "inquiry":
-        try:
-            user_id = int(id_val)
-            row = await safe_db_fetchone("SELECT * FROM users WHERE telegram_id = %s", (user_id,))
-            if not row:
-                await q.message.reply_text("❌ المستخدم غير موجود.", parse_mode="HTML")
-                return
-            status = "نشط" if row["subscription_active"] == 1 else "غير نشط"
-            await q.message.reply_text(
-                f"ℹ️ استعلام عن المستخدم {row['telegram_id']}:\n"
-                f"👤 المعرف: @{row['username'] or '---'}\n"
-                f"💰 الرصيد: {row['referral_balance']}$\n"
-                f"📌 حالة الاشتراك: {status}\n"
-                f"🗓️ انتهاء الاشتراك: {row['subscription_end'] or '---'}\n"
-                f"👥 المُحيل: {row['referrer_id'] or '---'}",
-                parse_mode="HTML"
-            )
-        except (ValueError, TypeError):
-            await q.message.reply_text("❌ معرّف غير صالح.")
+@router.route("approve", admin=True)
+async def approve_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        pid = int(id_val)
+        context.user_data.update({
+            "state": STATE_APPROVE_PID,
+            "approve_pid": pid
+        })
+        await q.message.reply_text("🔢 أدخل رقم العملية:")
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
 
-    elif action == "edit":
-        key_map = {"price": "subscription_price", "ref": "referral_reward", "min": "min_withdraw"}
-        key = key_map.get(id_val)
-        if key:
-            context.user_data["state"] = STATE_EDIT_SETTING + key
-            await q.message.reply_text(f"أدخل القيمة الجديدة لـ '{id_val}':")
+@router.route("reject", admin=True)
+async def reject_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    await update.callback_query.message.reply_text("⚠️ تأكيد الرفض؟", reply_markup=confirm_menu("✅", "❌", f"confirm_reject:{id_val}", "cancel:op"))
 
-    elif action == "add_payment" and id_val == "new":
-        context.user_data["state"] = STATE_ADD_PAYMENT_NAME
-        await q.message.reply_text("✏️ أرسل اسم طريقة الدفع:")
+@router.route("confirm_reject", admin=True, idempotent=True)
+async def confirm_reject_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        pid = int(id_val)
+        row = await safe_db_fetchone(
+            "UPDATE payments SET status = 'REJECTED' WHERE id = %s AND status = 'PENDING' RETURNING id", (pid,)
+        )
+        forget_payment(pid)
+        text = "❌ تم الرفض." if row else "❌ الطلب غير موجود أو مُعالج مسبقًا."
+        await q.message.reply_text(text, parse_mode="HTML")
+        return text
+    except Exception as e:
+        logger.error(f"Reject failed: {e}")
+        await q.message.reply_text("❌ خطأ في المعالجة.")
 
-    elif action == "edit_pm":
-        try:
-            m_id = int(id_val)
-            context.user_data["state"] = STATE_EDIT_PM + str(m_id)
-            await q.message.reply_text("أدخل الاسم الجديد:")
-        except (ValueError, TypeError):
-            await q.message.reply_text("❌ معرّف غير صالح.")
+@router.route("pay", admin=True)
+async def pay_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        wid = int(id_val)
+        context.user_data.update({
+            "state": STATE_PAY_WID,
+            "pay_wid": wid
+        })
+        await q.message.reply_text("🔢 أدخل رقم العملية:")
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
 
-    elif action == "del_pm":
-        await q.message.reply_text("⚠️ حذف الطريقة؟", reply_markup=confirm_menu("✅", "❌", f"confirm_del_pm:{id_val}", "cancel:op"))
+@router.route("cancel_w", admin=True)
+async def cancel_w_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    await update.callback_query.message.reply_text("⚠️ تأكيد إلغاء طلب السحب؟", reply_markup=confirm_menu("✅", "❌", f"confirm_cancel_w:{id_val}", "cancel:op"))
 
-    elif action == "confirm_del_pm":
-        try:
-            m_id = int(id_val)
-            await safe_db_execute("DELETE FROM payment_methods WHERE id = %s", (m_id,))
-            await q.message.reply_text("✅ تم الحذف.", parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Delete payment method failed: {e}")
-            await q.message.reply_text("❌ خطأ في الحذف.")
+@router.route("confirm_cancel_w", admin=True, idempotent=True)
+async def confirm_cancel_w_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        wid = int(id_val)
+        async with transaction() as conn:
+            row = await ledger.reverse(conn, wid)
+            if row:
+                await outbox.enqueue([
+                    outbox.message(row["user_id"], "❌ تم إلغاء طلب سحب أرباحك. تواصل مع الدعم للمزيد.")
+                ], conn)
+        if not row:
+            text = "❌ الطلب غير موجود أو مُعالج مسبقًا."
+            await q.message.reply_text(text)
+            return text
+        outbox.wake()
+        text = "✅ تم الإلغاء."
+        await q.message.reply_text(text, parse_mode="HTML")
+        return text
+    except Exception as e:
+        logger.error(f"Cancel withdrawal failed: {e}")
+        await q.message.reply_text("❌ خطأ في المعالجة.")
 
-    elif action == "add_links" and id_val == "bulk":
-        context.user_data["state"] = "add_links:bulk"
+@router.route("inquiry", admin=True)
+async def inquiry_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        user_id = int(id_val)
+        row = await safe_db_fetchone("SELECT * FROM users WHERE telegram_id = %s", (user_id,))
+        if not row:
+            await q.message.reply_text("❌ المستخدم غير موجود.", parse_mode="HTML")
+            return
+        available, held = await ledger.balance(user_id)
+        status = "نشط" if row["subscription_active"] == 1 else "غير نشط"
         await q.message.reply_text(
-            "📎 أرسل جميع روابط القناة في رسالة واحدة (كل رابط في سطر):\n\n"
-            "مثال:\n`https://t.me/channel1`\n`https://t.me/channel2`",
+            f"ℹ️ استعلام عن المستخدم {row['telegram_id']}:\n"
+            f"👤 المعرف: @{row['username'] or '---'}\n"
+            f"💰 الرصيد: {available}$ (محجوز: {held}$)\n"
+            f"📌 حالة الاشتراك: {status}\n"
+            f"🗓️ انتهاء الاشتراك: {row['subscription_end'] or '---'}\n"
+            f"👥 المُحيل: {row['referrer_id'] or '---'}",
             parse_mode="HTML"
         )
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
 
-    elif action == "del_link":
-        await q.message.reply_text("⚠️ حذف الرابط؟", reply_markup=confirm_menu("✅", "❌", f"confirm_del_link:{id_val}", "cancel:op"))
+@router.route("add_payment", admin=True)
+async def add_payment_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    if id_val != "new":
+        return
+    context.user_data["state"] = STATE_ADD_PAYMENT_NAME
+    await update.callback_query.message.reply_text("✏️ أرسل اسم طريقة الدفع:")
 
-    elif action == "confirm_del_link":
-        try:
-            lid = int(id_val)
-            await safe_db_execute("DELETE FROM channel_links WHERE id = %s", (lid,))
-            await q.message.reply_text("✅ تم الحذف.", parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Delete link failed: {e}")
-            await q.message.reply_text("❌ خطأ في الحذف.")
+@router.route("edit_pm", admin=True)
+async def edit_pm_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        m_id = int(id_val)
+        context.user_data["state"] = STATE_EDIT_PM + str(m_id)
+        await q.message.reply_text("أدخل الاسم الجديد:")
+    except (ValueError, TypeError):
+        await q.message.reply_text("❌ معرّف غير صالح.")
+
+@router.route("del_pm", admin=True)
+async def del_pm_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    await update.callback_query.message.reply_text("⚠️ حذف الطريقة؟", reply_markup=confirm_menu("✅", "❌", f"confirm_del_pm:{id_val}", "cancel:op"))
+
+@router.route("confirm_del_pm", admin=True, idempotent=True)
+async def confirm_del_pm_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        m_id = int(id_val)
+        row = await safe_db_fetchone("DELETE FROM payment_methods WHERE id = %s RETURNING id", (m_id,))
+        if row:
+            await catalog.changed()
+        text = "✅ تم الحذف." if row else "❌ الطريقة محذوفة مسبقًا."
+        await q.message.reply_text(text, parse_mode="HTML")
+        return text
+    except Exception as e:
+        logger.error(f"Delete payment method failed: {e}")
+        await q.message.reply_text("❌ خطأ في الحذف.")
+
+@router.route("add_links", admin=True)
+async def add_links_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    if id_val != "bulk":
+        return
+    context.user_data["state"] = "add_links:bulk"
+    await update.callback_query.message.reply_text(
+        "📎 أرسل جميع روابط القناة في رسالة واحدة (كل رابط في سطر)، أو ملف .txt / .csv:\n\n"
+        "مثال:\n`https://t.me/channel1`\n`https://t.me/channel2`",
+        parse_mode="HTML"
+    )
+
+@router.route("del_link", admin=True)
+async def del_link_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    await update.callback_query.message.reply_text("⚠️ حذف الرابط؟", reply_markup=confirm_menu("✅", "❌", f"confirm_del_link:{id_val}", "cancel:op"))
+
+@router.route("confirm_del_link", admin=True, idempotent=True)
+async def confirm_del_link_route(update: Update, context: ContextTypes.DEFAULT_TYPE, id_val, extra):
+    q = update.callback_query
+    try:
+        lid = int(id_val)
+        row = await safe_db_fetchone("DELETE FROM channel_links WHERE id = %s RETURNING id", (lid,))
+        if row:
+            await link_pool.refresh_depth()
+        text = "✅ تم الحذف." if row else "❌ الرابط محذوف مسبقًا."
+        await q.message.reply_text(text, parse_mode="HTML")
+        return text
+    except Exception as e:
+        logger.error(f"Delete link failed: {e}")
+        await q.message.reply_text("❌ خطأ في الحذف.")
+
+# ---------------- SQL ----------------
+# الموافقة على الاشتراك كعملية ذرية واحدة: حجز رابط (SKIP LOCKED) ← اعتماد الدفع ← تفعيل المستخدم
+# ← قيد مكافأة للمُحيل النشط في الدفتر ← حذف الرابط ← إشعار المستخدم في الصندوق الصادر. كل ذلك في معاملة واحدة وذهاب وإياب واحد للقاعدة.
+APPROVE_PAYMENT_SQL = """
+    WITH link AS (
+        SELECT id, link FROM channel_links
+        ORDER BY id LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), pay AS (
+        UPDATE payments SET status = 'APPROVED', transaction_id = %(txn)s
+        WHERE id = %(pid)s AND status = 'PENDING' AND EXISTS (SELECT 1 FROM link)
+          AND EXISTS (SELECT 1 FROM users WHERE telegram_id = payments.user_id)
+        RETURNING user_id
+    ), sub AS (
+        UPDATE users u SET subscription_active = TRUE, renewal_reminded = FALSE,
+            subscription_end = GREATEST(u.subscription_end, CURRENT_DATE) + %(days)s::int
+        FROM pay WHERE u.telegram_id = pay.user_id
+        RETURNING u.referrer_id
+    ), reward AS (
+        SELECT r.telegram_id FROM users r JOIN sub ON r.telegram_id = sub.referrer_id
+        WHERE r.subscription_active
+    ), credit AS (
+        INSERT INTO ledger_entries (user_id, kind, amount, payment_id)
+        SELECT telegram_id, 'credit', %(reward)s::numeric, %(pid)s FROM reward
+    ), balance AS (
+        INSERT INTO ledger_balances (user_id, available)
+        SELECT telegram_id, %(reward)s::numeric FROM reward
+        ON CONFLICT (user_id) DO UPDATE
+        SET available = ledger_balances.available + EXCLUDED.available, updated_at = NOW()
+    ), used AS (
+        DELETE FROM channel_links c USING link, pay
+        WHERE c.id = link.id
+        RETURNING c.link
+    ), notify AS (
+        INSERT INTO outbox (chat_id, kind, payload)
+        SELECT pay.user_id, 'message', jsonb_build_object(
+            'text', '🎉 اشتراكك مفعل!' || chr(10) || 'الرابط:' || chr(10) || used.link,
+            'parse_mode', 'HTML'
+        )
+        FROM pay, used
+    )
+    SELECT
+        (SELECT status FROM payments WHERE id = %(pid)s) AS status,
+        EXISTS (SELECT 1 FROM link) AS has_link,
+        EXISTS (SELECT 1 FROM payments p JOIN users u ON u.telegram_id = p.user_id WHERE p.id = %(pid)s) AS has_user,
+        (SELECT user_id FROM pay) AS user_id,
+        (SELECT link FROM used) AS link,
+        (SELECT telegram_id FROM reward) AS rewarded_referrer
+"""
 
 # ---------------- MESSAGES ----------------
+async def ingest_links(update: Update, lines):
+    try:
+        result = await link_pool.ingest(lines)
+    except Exception as e:
+        logger.error(f"Link ingest failed: {e}")
+        await update.message.reply_text("❌ خطأ في الحفظ.", parse_mode="HTML")
+        return
+    if not (result.added or result.duplicate):
+        await update.message.reply_text("❌ لم يتم العثور على روابط صالحة.", parse_mode="HTML")
+        return
+    await update.message.reply_text(
+        f"✅ تم حفظ {result.added} رابط.\n"
+        f"♻️ مكرر: {result.duplicate}\n"
+        f"⚠️ غير صالح: {result.invalid}",
+        parse_mode="HTML"
+    )
+
+@per_user
+async def links_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ملف .txt/.csv بالروابط (بلا حد لطول الرسالة) أثناء انتظار إضافة الروابط"""
+    if context.user_data.get("state") != "add_links:bulk":
+        return
+    clean_user_data(context, ["state"])
+    await update.message.reply_text("⏳ جارٍ تحميل الملف...")
+    # التحميل والإدراج في الخلفية حتى لا يحجز الملف الكبير قفل الأدمن
+    spawn(load_links_file(update))
+
+async def load_links_file(update: Update):
+    try:
+        file = await update.message.document.get_file()
+        data = await file.download_as_bytearray()
+    except Exception as e:
+        logger.error(f"Links file download failed: {e}")
+        await update.message.reply_text("❌ تعذر تحميل الملف (الحد الأقصى 20MB).", parse_mode="HTML")
+        return
+    await ingest_links(update, io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", errors="replace"))
+
+def message_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """الحالة الحالية كوسم للمقاييس؛ الحالات ذات اللاحقة تُختصر إلى بادئتها"""
+    state = context.user_data.get("state", STATE_IDLE)
+    for prefix in (STATE_EDIT_SETTING, STATE_EDIT_PM):
+        if state.startswith(prefix):
+            return prefix
+    return state
+
+@per_user
+@metrics.timed("message", message_state)
 async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
@@ -514,11 +774,8 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- دعم ---
     if state == STATE_SUPPORT:
-        for admin in ADMINS:
-            try:
-                await context.bot.send_message(admin, f"📩 دعم من {uid}:\n{text}")
-            except Exception as e:
-                logger.warning(f"Support msg to admin failed: {e}")
+        await outbox.enqueue([outbox.message(admin, f"📩 دعم من {uid}:\n{text}", parse_mode=None) for admin in ADMINS])
+        outbox.wake()
         clean_user_data(context, ["state"])
         await update.message.reply_text("✅ تم الإرسال.", parse_mode="HTML")
         return
@@ -617,7 +874,7 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- صورة إثبات الدفع ---
     if state == STATE_AWAITING_PAYMENT and update.message.photo:
-        price = (await safe_db_fetchone("SELECT value FROM settings WHERE key = 'subscription_price'"))["value"]
+        price = await settings.get("subscription_price")
         method_id = context.user_data.get("payment_method_id")
         if not method_id:
             clean_user_data(context, ["state", "payment_method_id"])
@@ -625,28 +882,24 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         file_id = update.message.photo[-1].file_id
         try:
-            row = await safe_db_fetchone("""
-                INSERT INTO payments (user_id, amount, proof, status, payment_method_id)
-                VALUES (%s, %s, %s, 'PENDING', %s)
-                RETURNING id
-            """, (uid, price, file_id, method_id))
-            pid = row["id"]
+            async with transaction() as conn:
+                cur = await conn.execute("""
+                    INSERT INTO payments (user_id, amount, proof, status, payment_method_id)
+                    VALUES (%s, %s, %s, 'PENDING', %s)
+                    RETURNING id
+                """, (uid, price, file_id, method_id))
+                pid = (await cur.fetchone())["id"]
+                markup = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✅", callback_data=f"approve:{pid}")],
+                    [InlineKeyboardButton("❌", callback_data=f"reject:{pid}")]
+                ])
+                await outbox.enqueue([
+                    outbox.photo(admin, file_id, f"طلب اشتراك جديدnالمستخدم: {uid}", reply_markup=markup)
+                    for admin in ADMINS
+                ], conn)
+            outbox.wake()
             clean_user_data(context, ["state", "payment_method_id"])
             await update.message.reply_text("📩 تم استلام صورة إشعار الدفع.", parse_mode="HTML")
-            # إشعار الأدمن
-            for admin in ADMINS:
-                try:
-                    await context.bot.send_photo(
-                        admin, photo=file_id,
-                        caption=f"طلب اشتراك جديدnالمستخدم: {uid}",
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("✅", callback_data=f"approve:{pid}")],
-                            [InlineKeyboardButton("❌", callback_data=f"reject:{pid}")]
-                        ])
-                    )
-                except Exception as e:
-                    logger.warning(f"Payment photo to admin failed: {e}")
         except Exception as e:
             logger.error(f"Payment insert failed: {e}")
             await update.message.reply_text("❌ خطأ في تسجيل الدفع.", parse_mode="HTML")
@@ -673,6 +926,7 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "INSERT INTO payment_methods (name, barcode) VALUES (%s, %s)",
                 (name, text)
             )
+            await catalog.changed()
             clean_user_data(context, ["state", "new_payment_name"])
             await update.message.reply_text("✅ تم الإضافة بنجاح!", parse_mode="HTML")
         except Exception as e:
@@ -683,25 +937,7 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- إضافة روابط دفعة واحدة ---
     if state == "add_links:bulk":
         clean_user_data(context, ["state"])
-        lines = text.strip().splitlines()
-        links = [line.strip() for line in lines if line.strip().startswith("http")]
-        if not links:
-            await update.message.reply_text("❌ لم يتم العثور على روابط صالحة.", parse_mode="HTML")
-            return
-        added = 0
-        for link in links:
-            try:
-                row = await safe_db_fetchone("""
-                    INSERT INTO channel_links (link)
-                    VALUES (%s)
-                    ON CONFLICT (link) DO NOTHING
-                    RETURNING id
-                """, (link,))
-                if row:
-                    added += 1
-            except Exception as e:
-                logger.error(f"Link insert failed: {link} | {e}")
-        await update.message.reply_text(f"✅ تم حفظ {added} رابط.", parse_mode="HTML")
+        await ingest_links(update, text.splitlines())
         return
 
     # --- الموافقة على الاشتراك (أدخل رقم العملية) ---
@@ -712,53 +948,37 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ خطأ داخلي. أعد المحاولة.")
             return
         try:
-            row = await safe_db_fetchone(
-                "SELECT user_id FROM payments WHERE id = %s AND status = 'PENDING'", (pid,)
-            )
-            if not row:
+            params = {
+                "pid": pid,
+                "txn": text,
+                "days": await settings.get_int("subscription_days"),
+                "reward": await settings.get("referral_reward"),
+            }
+            row = await safe_db_fetchone(APPROVE_PAYMENT_SQL, params)
+            if not row["user_id"] and row["status"] == "PENDING" and not row["has_link"]:
+                # نفد المخزون: توليد رابط فوري بدل إيقاف الموافقة
+                if await link_pool.top_up(context.bot, 1):
+                    row = await safe_db_fetchone(APPROVE_PAYMENT_SQL, params)
+            if not row["user_id"] and row["status"] == "PENDING" and not row["has_user"]:
+                # تسجيل المستخدم ما زال في ذاكرة التجميع: نكتبه ثم نعيد المحاولة (دون تفعيل اشتراك بلا صف)
+                await registrations.flush()
+                row = await safe_db_fetchone(APPROVE_PAYMENT_SQL, params)
+            if not row["user_id"]:
+                if row["status"] == "PENDING" and not row["has_link"]:
+                    await update.message.reply_text("❌ لا توجد روابط. أضف روابط أولًا.", parse_mode="HTML")
+                    return
+                if row["status"] == "PENDING" and not row["has_user"]:
+                    await update.message.reply_text(
+                        "⏳ المستخدم لم يُسجَّل بعد. أعد إرسال رقم العملية بعد لحظات.", parse_mode="HTML"
+                    )
+                    return
                 clean_user_data(context, ["state", "approve_pid"])
                 await update.message.reply_text("❌ الطلب غير موجود أو مُعالج مسبقًا.", parse_mode="HTML")
                 return
+            outbox.wake()
+            forget_payment(pid)
+            link_pool.claimed(context.bot, ADMINS)
             user_id = row["user_id"]
-            link_row = await safe_db_fetchone("SELECT id, link FROM channel_links ORDER BY id LIMIT 1")
-            if not link_row:
-                await update.message.reply_text("❌ لا توجد روابط. أضف روابط أولًا.", parse_mode="HTML")
-                return
-            link_id = link_row["id"]
-            link = link_row["link"]
-            end_date = "2026-12-31"
-            await safe_db_execute(
-                "UPDATE payments SET status = 'APPROVED', transaction_id = %s WHERE id = %s",
-                (text, pid)
-            )
-            await safe_db_execute(
-                "UPDATE users SET subscription_active = 1, subscription_end = %s WHERE telegram_id = %s",
-                (end_date, user_id)
-            )
-            # مكافأة المُحيل
-            ref_row = await safe_db_fetchone("SELECT referrer_id FROM users WHERE telegram_id = %s", (user_id,))
-            ref = ref_row["referrer_id"] if ref_row else None
-            if ref:
-                ref_active = await safe_db_fetchone(
-                    "SELECT subscription_active FROM users WHERE telegram_id = %s", (ref,)
-                )
-                if ref_active and ref_active["subscription_active"] == 1:
-                    reward = (await safe_db_fetchone(
-                        "SELECT value FROM settings WHERE key = 'referral_reward'"
-                    ))["value"]
-                    await safe_db_execute(
-                        "UPDATE users SET referral_balance = referral_balance + %s WHERE telegram_id = %s",
-                        (reward, ref)
-                    )
-            await safe_db_execute("DELETE FROM channel_links WHERE id = %s", (link_id,))
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    f"🎉 اشتراكك مفعل!\nالرابط:\n{ link }",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
             clean_user_data(context, ["state", "approve_pid"])
             await update.message.reply_text(f"✅ تم تفعيل الاشتراك لـ {user_id}.", parse_mode="HTML")
         except Exception as e:
@@ -775,35 +995,26 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ خطأ داخلي. أعد المحاولة.")
             return
         try:
-            row = await safe_db_fetchone(
-                "SELECT user_id, amount, sham_cash_link, method FROM withdrawals WHERE id = %s", (wid,)
-            )
+            async with transaction() as conn:
+                # تسوية حجز هذا الطلب فقط؛ الرصيد المتاح لا يُصفَّر
+                row = await ledger.payout(conn, wid, text)
+                if row:
+                    u = row["user_id"]
+                    amt = row["amount"]
+                    method = "شام كاش" if row["method"] == "sham" else "USDT (BEP20)"
+                    await outbox.enqueue([outbox.message(
+                        u,
+                        f"✅ تم صرف أرباحك بنجاح!nn"
+                        f"💵 المبلغ: {amt}$\n"
+                        f"🆔 رقم العملية: { text }\n"
+                        f"📌 الطريقة: {method}\n"
+                        f"📋 البيانات: `{ row['sham_cash_link'] or '' }`"
+                    )], conn)
             if not row:
                 clean_user_data(context, ["state", "pay_wid"])
-                await update.message.reply_text("❌ طلب السحب غير موجود.", parse_mode="HTML")
+                await update.message.reply_text("❌ طلب السحب غير موجود أو مُعالج مسبقًا.", parse_mode="HTML")
                 return
-            u = row["user_id"]
-            amt = row["amount"]
-            data = row["sham_cash_link"]
-            method_type = row["method"]
-            await safe_db_execute("UPDATE users SET referral_balance = 0 WHERE telegram_id = %s", (u,))
-            await safe_db_execute(
-                "UPDATE withdrawals SET status = 'PAID', transaction_id = %s WHERE id = %s",
-                (text, wid)
-            )
-            method = "شام كاش" if method_type == "sham" else "USDT (BEP20)"
-            try:
-                await context.bot.send_message(
-                    u,
-                    f"✅ تم صرف أرباحك بنجاح!nn"
-                    f"💵 المبلغ: {amt}$\n"
-                    f"🆔 رقم العملية: { text }\n"
-                    f"📌 الطريقة: {method}\n"
-                    f"📋 البيانات: `{ data or '' }`",
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logger.warning(f"User notification failed on payout: {e}")
+            outbox.wake()
             clean_user_data(context, ["state", "pay_wid"])
             await update.message.reply_text(f"✅ تم صرف {amt}$ لـ {u}.", parse_mode="HTML")
         except Exception as e:
@@ -816,11 +1027,8 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state.startswith(STATE_EDIT_SETTING):
         key = state[len(STATE_EDIT_SETTING):]
         try:
-            val = float(text) if key != "subscription_price" else int(text)
-            await safe_db_execute(
-                "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
-                (key, str(val))
-            )
+            val = int(text) if key in ("subscription_price", "subscription_days") else float(text)
+            await settings.set(key, str(val))
             clean_user_data(context, ["state"])
             await update.message.reply_text("✅ تم التعديل.", parse_mode="HTML")
         except ValueError:
@@ -832,6 +1040,7 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             m_id = int(state[len(STATE_EDIT_PM):])
             await safe_db_execute("UPDATE payment_methods SET name = %s WHERE id = %s", (text, m_id))
+            await catalog.changed()
             clean_user_data(context, ["state"])
             await update.message.reply_text("✅ تم التعديل.", parse_mode="HTML")
         except Exception as e:
@@ -843,26 +1052,13 @@ async def messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- بث جماعي ---
     if state == STATE_BROADCAST:
         clean_user_data(context, ["state"])
-        rows = await safe_db_fetchall("SELECT telegram_id FROM users")
-        user_ids = [r["telegram_id"] for r in rows]
-        total = len(user_ids)
-        if total == 0:
+        job_id = await broadcast.create_job(uid, text)
+        if not job_id:
             await update.message.reply_text("📭 لا يوجد مستخدمون.", parse_mode="HTML")
             return
-        success = 0
-        for i in range(0, total, BATCH_SIZE):
-            batch = user_ids[i:i + BATCH_SIZE]
-            tasks = [context.bot.send_message(uid, text, parse_mode=None) for uid in batch]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            success += sum(1 for r in results if not isinstance(r, Exception))
-            # توقف عند فشل > 30%
-            if i > 0 and success < (i + len(batch)) * 0.7:
-                await update.message.reply_text(
-                    f"⚠️ توقف مؤقت: نسبة فشل عالية ({success}/{i + len(batch)}).",
-                    parse_mode="HTML"
-                )
-                break
-        await update.message.reply_text(f"✅ تم الإرسال إلى {success}/{total} مستخدم.", parse_mode="HTML")
+        msg = await update.message.reply_text(f"📢 بدأ البث #{job_id}...", parse_mode="HTML")
+        await broadcast.set_progress_message(job_id, msg.message_id)
+        spawn(broadcast.run_job(context.bot, job_id))
         return
 
 # ---------------- COMMANDS ----------------
@@ -870,18 +1066,149 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id in ADMINS:
         await update.message.reply_text("🛂 لوحة الأدمن", reply_markup=admin_menu())
 
+async def routes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id in ADMINS:
+        await update.message.reply_text(f"⏱️ زمن المسارات:\n{router.report()}")
+
+async def referrals_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/referrals → لوحة المتصدرين، /referrals <user_id> [depth] → شجرة المستخدم"""
+    if update.effective_user.id not in ADMINS:
+        return
+    args = [a for a in context.args if a.isdigit()]
+    if not args:
+        await update.message.reply_text(await referral_stats.leaderboard_text())
+        return
+    depth = int(args[1]) if len(args) > 1 else referral_stats.REFERRAL_TREE_MAX_DEPTH
+    await update.message.reply_text(await referral_stats.tree_text(int(args[0]), depth))
+
+async def dbstats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+    if not DB_PROFILE:
+        await update.message.reply_text("ℹ️ التحليل معطّل. شغّل البوت مع DB_PROFILE=1.")
+        return
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    report = html.escape(profile_report(n)[:3800])
+    await update.message.reply_text(f"🗄️ أثقل الاستعلامات:\n<pre>{report}</pre>", parse_mode="HTML")
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export users|payments|withdrawals [from] [to] [xlsx] → ملف مضغوط يُرسل في الخلفية"""
+    if update.effective_user.id not in ADMINS:
+        return
+    parsed = export.parse_args(context.args)
+    if not parsed:
+        await update.message.reply_text(export.USAGE)
+        return
+    await update.message.reply_text("⏳ جارٍ تجهيز الملف...")
+    spawn(export.send_export(context.bot, update.effective_chat.id, *parsed))
+
 # ---------------- MAIN ----------------
-def main():
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+_background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    """تشغيل مهمة خلفية طويلة الأمد تُلغى عند إيقاف البوت"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def on_startup(app: Application):
+    await init_db()
+    if BOT_ROLE == "ingress":
+        # المدخل يكتب التحديثات في الطابور فقط؛ كل المعالجة في العمال
+        if metrics.METRICS_PORT:
+            spawn(metrics.serve())
+        return
+    if isinstance(app.persistence, PostgresPersistence):
+        app.persistence.attach(app)
+    await settings.load()
+    await catalog.load()
+    await link_pool.refresh_depth()
+    link_pool.check(app.bot, ADMINS)
+    if DB_NOTIFY_CHANNEL:
+        spawn(notify_listener(DB_NOTIFY_CHANNEL))
+    spawn(outbox.run_worker(app.bot))
+    metrics.UPDATE_QUEUE_DEPTH.set_function(app.update_queue.qsize)
+    if metrics.METRICS_PORT:
+        spawn(metrics.serve())
+    if not update_queue.is_primary():
+        return
+    for job_id in await broadcast.unfinished_jobs():
+        logger.info(f"🔁 Resuming broadcast #{job_id}")
+        spawn(broadcast.run_job(app.bot, job_id))
+
+async def on_shutdown(app: Application):
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await registrations.close()
+    await close_pool()
+
+def build_application() -> Application:
+    """بناء التطبيق وتسجيل المعالجات دون تشغيله (يُستخدم أيضًا في benchmark.py)"""
+    if BOT_ROLE != "all" and not DB_NOTIFY_CHANNEL:
+        # ذاكرات الإعدادات وطرق الدفع في كل عامل تتزامن فقط عبر LISTEN/NOTIFY
+        raise RuntimeError("❌ DB_NOTIFY_CHANNEL is required when BOT_ROLE is ingress/worker!")
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if PERSIST_STATE and BOT_ROLE != "ingress":
+        builder = builder.persistence(PostgresPersistence())
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, idempotency.drop_duplicate_update), group=-2)
+    if BOT_ROLE == "ingress":
+        app.add_handler(TypeHandler(Update, update_queue.enqueue_update), group=-1)
+        return app
+    if update_queue.is_primary():
+        subscriptions.schedule(app.job_queue)
+        referral_stats.schedule(app.job_queue)
     app.add_error_handler(error_handler)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_cmd))
-    app.add_handler(CallbackQueryHandler(callbacks))
+    app.add_handler(CommandHandler("routes", routes_cmd))
+    app.add_handler(CommandHandler("dbstats", dbstats_cmd))
+    app.add_handler(CommandHandler("referrals", referrals_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
+    for handler in router.handlers():
+        app.add_handler(handler)
+    app.add_handler(MessageHandler(
+        filters.User(ADMINS) & (filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv")),
+        links_document
+    ))
     app.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, messages))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, messages))
-    logger.info("✅ Jetoor Bot is running...")
-    app.run_polling(drop_pending_updates=True)
+    return app
+
+def main():
+    app = build_application()
+    if BOT_ROLE == "worker":
+        logger.info(f"✅ Jetoor worker {update_queue.WORKER_INDEX}/{update_queue.WORKER_COUNT} is running...")
+        update_queue.run_worker(app)
+        return
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("❌ WEBHOOK_URL (or RENDER_EXTERNAL_URL) is required in webhook mode!")
+        logger.info(f"✅ Jetoor Bot is running (webhook on {WEBHOOK_LISTEN}:{PORT}/{WEBHOOK_PATH})...")
+        # Telegram يحتفظ بالتحديثات أثناء إعادة التشغيل، وعند الإيقاف تُعالج التحديثات المعلقة قبل الخروج
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=False,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info("✅ Jetoor Bot is running...")
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
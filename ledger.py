@@ -0,0 +1,74 @@
+# ledger.py — دفتر أرباح الإحالة: قيود إلحاقية فقط (credit/hold/payout/reversal) مع رصيد محدَّث تدريجيًا
+#
+# أثر كل قيد على ledger_balances (المبالغ موجبة دائمًا، والنوع يحدد الاتجاه):
+#   credit   → available += amount
+#   hold     → available -= amount, held += amount   (عند تقديم طلب السحب)
+#   payout   → held -= amount                         (صرف الحجز نفسه)
+#   reversal → held -= amount, available += amount   (إلغاء الطلب وإعادة المبلغ)
+from decimal import Decimal
+from psycopg import AsyncConnection
+from database import safe_db_fetchone
+
+# حجز المبلغ وإنشاء الطلب معًا؛ لا شيء يُكتب إن كان الرصيد غير كافٍ أو لدى المستخدم طلب معلق
+HOLD_SQL = """
+    WITH bal AS (
+        UPDATE ledger_balances SET available = available - %(amount)s, held = held + %(amount)s, updated_at = NOW()
+        WHERE user_id = %(uid)s AND available >= %(amount)s
+          AND NOT EXISTS (SELECT 1 FROM withdrawals WHERE user_id = %(uid)s AND status = 'PENDING')
+        RETURNING user_id
+    ), w AS (
+        INSERT INTO withdrawals (user_id, amount, sham_cash_link, method, status)
+        SELECT %(uid)s, %(amount)s, %(data)s, %(method)s, 'PENDING' FROM bal
+        RETURNING id
+    ), entry AS (
+        INSERT INTO ledger_entries (user_id, kind, amount, withdrawal_id)
+        SELECT %(uid)s, 'hold', %(amount)s, id FROM w
+    )
+    SELECT id FROM w
+"""
+
+# إغلاق الطلب المعلق وتسوية حجزه بالضبط: payout يصرف الحجز و reversal يعيده للمتاح
+SETTLE_SQL = """
+    WITH w AS (
+        UPDATE withdrawals SET status = %(status)s, transaction_id = COALESCE(%(txn)s, transaction_id)
+        WHERE id = %(wid)s AND status = 'PENDING'
+        RETURNING id, user_id, amount, sham_cash_link, method
+    ), hold AS (
+        SELECT h.user_id, h.amount, h.withdrawal_id FROM ledger_entries h JOIN w ON h.withdrawal_id = w.id
+        WHERE h.kind = 'hold'
+    ), bal AS (
+        UPDATE ledger_balances b SET
+            held = b.held - hold.amount,
+            available = b.available + CASE WHEN %(kind)s = 'reversal' THEN hold.amount ELSE 0 END,
+            updated_at = NOW()
+        FROM hold WHERE b.user_id = hold.user_id
+        RETURNING b.user_id
+    ), entry AS (
+        INSERT INTO ledger_entries (user_id, kind, amount, withdrawal_id)
+        SELECT user_id, %(kind)s, amount, withdrawal_id FROM hold
+    )
+    SELECT * FROM w
+"""
+
+
+async def balance(user_id: int) -> tuple[Decimal, Decimal]:
+    """(المتاح، المحجوز) بقراءة صف واحد"""
+    row = await safe_db_fetchone("SELECT available, held FROM ledger_balances WHERE user_id = %s", (user_id,))
+    return (row["available"], row["held"]) if row else (Decimal(0), Decimal(0))
+
+
+async def hold(conn: AsyncConnection, user_id: int, amount, data: str, method: str) -> int | None:
+    """طلب سحب جديد مع حجز مبلغه؛ يُرجع رقم الطلب أو None"""
+    cur = await conn.execute(HOLD_SQL, {"uid": user_id, "amount": Decimal(str(amount)), "data": data, "method": method})
+    row = await cur.fetchone()
+    return row["id"] if row else None
+
+
+async def payout(conn: AsyncConnection, withdrawal_id: int, txn: str) -> dict | None:
+    cur = await conn.execute(SETTLE_SQL, {"wid": withdrawal_id, "status": "PAID", "kind": "payout", "txn": txn})
+    return await cur.fetchone()
+
+
+async def reverse(conn: AsyncConnection, withdrawal_id: int) -> dict | None:
+    cur = await conn.execute(SETTLE_SQL, {"wid": withdrawal_id, "status": "CANCELLED", "kind": "reversal", "txn": None})
+    return await cur.fetchone()
@@ -0,0 +1,196 @@
+# link_pool.py — مخزون روابط دعوة القناة: تتبّع العمق وإعادة التعبئة في الخلفية وتنبيه الأدمن
+import os
+import re
+import uuid
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from telegram import Bot
+from telegram.error import RetryAfter
+from typing import Iterable, NamedTuple
+from database import safe_db_fetchone, transaction
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_ID = os.getenv("CHANNEL_ID")
+# telegram (يتطلب CHANNEL_ID والبوت مشرفًا في القناة) | fake | none
+LINK_GENERATOR = os.getenv("LINK_GENERATOR", "telegram" if CHANNEL_ID else "none")
+LINK_POOL_LOW = int(os.getenv("LINK_POOL_LOW", "20"))
+LINK_POOL_TARGET = int(os.getenv("LINK_POOL_TARGET", "100"))
+
+# يقبل سطرًا فيه رابط فقط، أو صف CSV يكون الرابط أحد حقوله
+_LINK_RE = re.compile(r"https?://\S+")
+
+
+class IngestResult(NamedTuple):
+    added: int
+    duplicate: int
+    invalid: int
+
+
+def parse_links(lines: Iterable[str]):
+    """استخراج رابط واحد من كل سطر؛ يُرجع (الروابط كمولّد، عدّاد الأسطر غير الصالحة)"""
+    invalid = [0]
+
+    def links():
+        for line in lines:
+            line = line.strip().strip("\ufeff")
+            if not line:
+                continue
+            fields = (f.strip().strip('"') for f in re.split(r"[,;\t]", line))
+            found = next((f for f in fields if _LINK_RE.fullmatch(f)), None)
+            if found:
+                yield found
+            else:
+                invalid[0] += 1
+    return links(), invalid
+
+
+class LinkGenerator(ABC):
+    """واجهة مولّد الروابط؛ يمكن استبدالها بمولّد وهمي محليًا"""
+
+    @abstractmethod
+    async def generate(self, bot: Bot, count: int) -> list[str]:
+        ...
+
+
+class TelegramLinkGenerator(LinkGenerator):
+    """روابط دعوة لاستخدام واحد عبر createChatInviteLink"""
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+
+    async def generate(self, bot: Bot, count: int) -> list[str]:
+        links = []
+        while len(links) < count:
+            try:
+                invite = await bot.create_chat_invite_link(self.chat_id, member_limit=1)
+                links.append(invite.invite_link)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                # الروابط المنشأة فعّالة في Telegram؛ تُرجع لتُحفظ بدل أن تضيع مع الخطأ
+                if not links:
+                    raise
+                logger.warning(f"Invite link generation stopped after {len(links)}/{count}: {e}")
+                break
+        return links
+
+
+class FakeLinkGenerator(LinkGenerator):
+    """مولّد محلي للاختبار دون Telegram"""
+
+    async def generate(self, bot: Bot, count: int) -> list[str]:
+        return [f"https://t.me/+fake{uuid.uuid4().hex[:16]}" for _ in range(count)]
+
+
+class LinkPool:
+    """يتتبع عدد الروابط المتاحة ويعيد التعبئة عند الوصول لحد التنبيه"""
+
+    def __init__(self, generator: LinkGenerator | None, low: int = LINK_POOL_LOW, target: int = LINK_POOL_TARGET):
+        self.generator = generator
+        self.low = low
+        self.target = target
+        self.depth: int | None = None
+        self._alerted = False
+        self._refilling: asyncio.Task | None = None
+        self._alerting: asyncio.Task | None = None
+
+    async def refresh_depth(self) -> int:
+        row = await safe_db_fetchone("SELECT count(*) AS n FROM channel_links")
+        self.depth = row["n"]
+        return self.depth
+
+    async def add(self, links: list[str]) -> int:
+        """إضافة روابط دفعة واحدة (المكرر يُتجاهل) وإرجاع عدد المضاف"""
+        if not links:
+            return 0
+        row = await safe_db_fetchone("""
+            WITH ins AS (
+                INSERT INTO channel_links (link) SELECT unnest(%s::text[])
+                ON CONFLICT (link) DO NOTHING
+                RETURNING 1
+            )
+            SELECT count(*) AS n FROM ins
+        """, (links,))
+        if self.depth is not None:
+            self.depth += row["n"]
+        return row["n"]
+
+    async def ingest(self, lines: Iterable[str]) -> IngestResult:
+        """
+        تحميل كميات كبيرة: بث الروابط بـ COPY إلى جدول مؤقت ثم INSERT ... SELECT واحد
+        يتجاهل المكرر (داخل الملف أو الموجود مسبقًا)
+        """
+        links, invalid = parse_links(lines)
+        async with transaction() as conn:
+            await conn.execute("CREATE TEMP TABLE link_staging (link TEXT NOT NULL) ON COMMIT DROP")
+            async with conn.cursor() as cur:
+                async with cur.copy("COPY link_staging (link) FROM STDIN") as copy:
+                    for link in links:
+                        await copy.write_row((link,))
+            cur = await conn.execute("""
+                WITH ins AS (
+                    INSERT INTO channel_links (link)
+                    SELECT DISTINCT link FROM link_staging
+                    ON CONFLICT (link) DO NOTHING
+                    RETURNING 1
+                )
+                SELECT (SELECT count(*) FROM ins) AS added, (SELECT count(*) FROM link_staging) AS staged
+            """)
+            row = await cur.fetchone()
+        if self.depth is not None:
+            self.depth += row["added"]
+        return IngestResult(row["added"], row["staged"] - row["added"], invalid[0])
+
+    async def top_up(self, bot: Bot, count: int) -> int:
+        """توليد روابط فورًا (تُستخدم عندما ينفد المخزون أثناء موافقة)"""
+        if not self.generator:
+            return 0
+        return await self.add(await self.generator.generate(bot, count))
+
+    def claimed(self, bot: Bot, admins):
+        """يُنادى بعد كل رابط مُستهلك؛ يطلق التعبئة والتنبيه عند الحاجة دون انتظار"""
+        if self.depth is not None:
+            self.depth = max(self.depth - 1, 0)
+        self.check(bot, admins)
+
+    def check(self, bot: Bot, admins):
+        if self.depth is None or self.depth > self.low:
+            self._alerted = False
+            return
+        if self.generator and (self._refilling is None or self._refilling.done()):
+            self._refilling = asyncio.create_task(self._refill(bot))
+        if not self._alerted:
+            self._alerted = True
+            self._alerting = asyncio.create_task(self._alert(bot, admins))
+
+    async def _refill(self, bot: Bot):
+        try:
+            depth = await self.refresh_depth()
+            if depth < self.target:
+                added = await self.top_up(bot, self.target - depth)
+                logger.info(f"🔗 Link pool refilled with {added} links (depth {self.depth}).")
+        except Exception as e:
+            logger.error(f"Link pool refill failed: {e}")
+
+    async def _alert(self, bot: Bot, admins):
+        text = f"⚠️ مخزون روابط القناة منخفض: {self.depth} رابط متبقٍ."
+        if self.generator:
+            text += "\n🔄 جارٍ التوليد تلقائيًا."
+        for admin in admins:
+            try:
+                await bot.send_message(admin, text)
+            except Exception as e:
+                logger.warning(f"Link pool alert to {admin} failed: {e}")
+
+
+def _make_generator() -> LinkGenerator | None:
+    if LINK_GENERATOR == "telegram" and CHANNEL_ID:
+        return TelegramLinkGenerator(CHANNEL_ID)
+    if LINK_GENERATOR == "fake":
+        return FakeLinkGenerator()
+    return None
+
+
+link_pool = LinkPool(_make_generator())
@@ -0,0 +1,209 @@
+# metrics.py — مقاييس بصيغة Prometheus (عدّادات، مقاييس لحظية، مدرجات زمنية) مع خادم HTTP محلي خفيف
+import os
+import time
+import asyncio
+import logging
+import functools
+from bisect import bisect_left
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# 0 = معطّل
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# حدود المدرج بالثواني (من 5ms حتى 10s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.series: dict[tuple, object] = {}
+        REGISTRY.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self.series.items()]
+
+
+class Gauge(_Metric):
+    """قيمة لحظية؛ تُضبط يدويًا أو تُقرأ من دالة عند كل سحب"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.functions: dict[tuple, object] = {}
+
+    def set(self, *labels, value: float):
+        self.series[labels] = value
+
+    def set_function(self, func, *labels):
+        self.functions[labels] = func
+
+    def render(self) -> list[str]:
+        values = dict(self.series)
+        for k, func in self.functions.items():
+            try:
+                values[k] = func()
+            except Exception:
+                continue
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, *labels, value: float):
+        # [عدادات الحدود..., +Inf, المجموع]؛ العدادات غير تراكمية هنا وتُجمع عند العرض فقط
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = []
+        for k, s in self.series.items():
+            total = 0
+            for bound, n in zip(self.buckets + ("+Inf",), s):
+                total += n
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, k, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, k)} {s[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, k)} {total}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "started")
+
+    def __init__(self, hist: Histogram, labels: tuple):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(*self.labels, value=time.perf_counter() - self.started)
+        return False
+
+
+REGISTRY: list[_Metric] = []
+
+# ---------------- المقاييس ----------------
+HANDLER_LATENCY = Histogram("jetoor_handler_seconds", "Handler latency by callback action or message state", ("kind", "name"))
+HANDLER_ERRORS = Counter("jetoor_handler_errors_total", "Handler exceptions by callback action or message state", ("kind", "name"))
+DB_LATENCY = Histogram("jetoor_db_query_seconds", "safe_db_* query latency", ("op", "query"))
+DB_ERRORS = Counter("jetoor_db_query_errors_total", "safe_db_* query errors", ("op", "query"))
+API_LATENCY = Histogram("jetoor_bot_api_seconds", "Outbound Bot API call latency", ("method",))
+API_FLOOD_WAITS = Counter("jetoor_bot_api_flood_waits_total", "Bot API 429 responses (flood wait)", ("method",))
+BROADCAST_MESSAGES = Counter("jetoor_broadcast_messages_total", "Broadcast deliveries", ("result",))
+OUTBOX_MESSAGES = Counter("jetoor_outbox_messages_total", "Outbox deliveries", ("result",))
+UPDATE_QUEUE_DEPTH = Gauge("jetoor_update_queue_depth", "Updates waiting in the application queue")
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.header()
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def timed(kind: str, name_of):
+    """مزخرف لمعالج PTB يقيس زمنه تحت الاسم الذي تُرجعه name_of(update, context) قبل التنفيذ"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, context):
+            name = name_of(update, context)
+            started = time.perf_counter()
+            try:
+                return await func(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(kind, name)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(kind, name, value=time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# ---------------- Bot API ----------------
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest يقيس زمن كل استدعاء للـ Bot API ويعدّ ردود 429"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        finally:
+            API_LATENCY.observe(api_method, value=time.perf_counter() - started)
+        if code == 429:
+            API_FLOOD_WAITS.inc(api_method)
+        return code, payload
+
+
+# ---------------- HTTP ----------------
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body, status = render().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """خدمة /metrics حتى الإلغاء"""
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"📈 Metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,273 @@
+# migrations.py — ترحيلات المخطط بإصدارات متسلسلة (تُطبّق المعلقة فقط عند الإقلاع)
+import logging
+from typing import NamedTuple
+from psycopg import AsyncConnection, sql
+
+logger = logging.getLogger(__name__)
+
+# مفتاح قفل استشاري يمنع تشغيل الترحيل من نسختين في نفس الوقت
+MIGRATION_LOCK_KEY = 7_310_2026
+
+
+class Migration(NamedTuple):
+    """ترحيل واحد؛ يجب أن تكون أوامره قابلة للإعادة (IF NOT EXISTS) في حال انقطاع التطبيق قبل تسجيله"""
+    version: int
+    name: str
+    # أوامر تُنفذ داخل معاملة واحدة
+    statements: tuple = ()
+    # فهارس (الاسم، التعريف) تُبنى بـ CREATE INDEX CONCURRENTLY خارج المعاملات
+    indexes: tuple = ()
+
+
+MIGRATIONS = [
+    Migration(1, "baseline tables", statements=(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            username TEXT,
+            referrer_id BIGINT,
+            referral_balance DECIMAL(10,2) DEFAULT 0,
+            subscription_active BOOLEAN DEFAULT FALSE,
+            subscription_end DATE,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """,
+        """
+        INSERT INTO settings (key, value) VALUES
+            ('subscription_price', '5'), ('referral_reward', '1'), ('min_withdraw', '2')
+        ON CONFLICT (key) DO NOTHING
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payment_methods (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            barcode TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount DECIMAL(10,2) NOT NULL,
+            proof TEXT,
+            status TEXT DEFAULT 'PENDING',
+            payment_method_id INTEGER,
+            transaction_id TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount DECIMAL(10,2) NOT NULL,
+            sham_cash_link TEXT,
+            method TEXT DEFAULT 'sham',
+            status TEXT DEFAULT 'PENDING',
+            transaction_id TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS channel_links (
+            id SERIAL PRIMARY KEY,
+            link TEXT UNIQUE NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'RUNNING',
+            last_user_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            progress_message_id BIGINT,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+    )),
+    Migration(2, "hot lookup indexes", indexes=(
+        ("idx_payments_pending", "payments (status, id) WHERE status = 'PENDING'"),
+        ("idx_withdrawals_pending", "withdrawals (status, id) WHERE status = 'PENDING'"),
+        ("idx_withdrawals_user_status", "withdrawals (user_id, status)"),
+        ("idx_users_referrer", "users (referrer_id) WHERE referrer_id IS NOT NULL"),
+    )),
+    Migration(3, "conversation state", statements=(
+        """
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+    )),
+    Migration(4, "notification outbox", statements=(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'message',
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at, id) WHERE status = 'PENDING'",
+    )),
+    Migration(5, "referral ledger", statements=(
+        """
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('credit', 'hold', 'payout', 'reversal')),
+            amount DECIMAL(12,2) NOT NULL CHECK (amount >= 0),
+            payment_id INTEGER,
+            withdrawal_id INTEGER,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ledger_balances (
+            user_id BIGINT PRIMARY KEY,
+            available DECIMAL(12,2) NOT NULL DEFAULT 0 CHECK (available >= 0),
+            held DECIMAL(12,2) NOT NULL DEFAULT 0 CHECK (held >= 0),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger_entries (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_withdrawal ON ledger_entries (withdrawal_id) WHERE withdrawal_id IS NOT NULL",
+        # الأرصدة الافتتاحية من users.referral_balance، مع حجز مبالغ طلبات السحب المعلقة حاليًا
+        """
+        INSERT INTO ledger_entries (user_id, kind, amount)
+        SELECT telegram_id, 'credit', referral_balance FROM users
+        WHERE referral_balance > 0 AND NOT EXISTS (SELECT 1 FROM ledger_entries)
+        """,
+        """
+        INSERT INTO ledger_entries (user_id, kind, amount, withdrawal_id)
+        SELECT user_id, 'hold', amount, id FROM withdrawals
+        WHERE status = 'PENDING' AND NOT EXISTS (SELECT 1 FROM ledger_entries WHERE kind = 'hold')
+        """,
+        """
+        INSERT INTO ledger_balances (user_id, available, held)
+        SELECT u.telegram_id, GREATEST(u.referral_balance - COALESCE(w.amount, 0), 0), COALESCE(w.amount, 0)
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, sum(amount) AS amount FROM withdrawals WHERE status = 'PENDING' GROUP BY user_id
+        ) w ON w.user_id = u.telegram_id
+        WHERE u.referral_balance > 0 OR w.amount IS NOT NULL
+        ON CONFLICT (user_id) DO NOTHING
+        """,
+    )),
+    Migration(6, "subscription expiry", statements=(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS renewal_reminded BOOLEAN NOT NULL DEFAULT FALSE",
+    ), indexes=(
+        ("idx_users_subscription_end", "users (subscription_end) WHERE subscription_active"),
+    )),
+    # العروض المادية تُحدَّث بـ REFRESH ... CONCURRENTLY، وهذا يتطلب فهرسًا فريدًا على كل منها
+    Migration(7, "referral analytics views", statements=(
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS referral_edges AS
+        SELECT u.telegram_id, u.referrer_id,
+               EXISTS (SELECT 1 FROM payments p WHERE p.user_id = u.telegram_id AND p.status = 'APPROVED') AS paid
+        FROM users u
+        WHERE u.referrer_id IS NOT NULL
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_edges_user ON referral_edges (telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_referral_edges_referrer ON referral_edges (referrer_id)",
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS referral_stats AS
+        WITH referred AS (
+            SELECT referrer_id, count(*) AS referred, count(*) FILTER (WHERE paid) AS paid
+            FROM referral_edges GROUP BY referrer_id
+        ), earned AS (
+            SELECT user_id, sum(amount) AS earned FROM ledger_entries
+            WHERE kind = 'credit' AND payment_id IS NOT NULL
+            GROUP BY user_id
+        )
+        SELECT r.referrer_id, r.referred, r.paid, COALESCE(e.earned, 0) AS earned
+        FROM referred r LEFT JOIN earned e ON e.user_id = r.referrer_id
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_stats_referrer ON referral_stats (referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_referral_stats_rank ON referral_stats (paid DESC, referred DESC)",
+    )),
+    # طابور التحديثات لوضع العمال المتعددين؛ update_id فريد حتى لا يُكرر إعادة إرسال webhook التحديث.
+    # bucket سلة ثابتة للمستخدم (0..UPDATE_QUEUE_BUCKETS-1)، وكل عامل يحجز السلال التي bucket % WORKER_COUNT
+    # فيها = ترتيبه، فتغيير عدد العمال يعيد توزيع السلال دون صفوف عالقة
+    Migration(8, "update queue", statements=(
+        """
+        CREATE TABLE IF NOT EXISTS update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            bucket INTEGER NOT NULL,
+            user_key BIGINT NOT NULL,
+            update_id BIGINT NOT NULL UNIQUE,
+            payload JSONB NOT NULL,
+            locked_until TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_update_queue_bucket ON update_queue (bucket, id)",
+    )),
+]
+
+
+async def _build_index(conn: AsyncConnection, name: str, definition: str):
+    """بناء فهرس دون قفل الكتابة؛ الفهرس غير الصالح من محاولة فاشلة سابقة يُحذف ويُعاد بناؤه"""
+    cur = await conn.execute(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+        (name,)
+    )
+    row = await cur.fetchone()
+    if row is not None:
+        if row["indisvalid"]:
+            return
+        await conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+    await conn.execute(
+        sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON ").format(sql.Identifier(name))
+        + sql.SQL(definition)
+    )
+
+
+async def apply_migrations(conn: AsyncConnection) -> list[int]:
+    """تطبيق الترحيلات المعلقة على اتصال autocommit (dict_row) وإرجاع الإصدارات المطبّقة"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    await conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        cur = await conn.execute("SELECT version FROM schema_migrations")
+        applied = {r["version"] for r in await cur.fetchall()}
+        done = []
+        for m in sorted(MIGRATIONS, key=lambda m: m.version):
+            if m.version in applied:
+                continue
+            logger.info(f"🔧 Applying migration {m.version}: {m.name}")
+            async with conn.transaction():
+                for statement in m.statements:
+                    await conn.execute(statement)
+            for name, definition in m.indexes:
+                await _build_index(conn, name, definition)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (m.version, m.name)
+            )
+            done.append(m.version)
+        return done
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
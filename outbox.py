@@ -0,0 +1,185 @@
+# outbox.py — صندوق صادر دائم للإشعارات: يُكتب مع التغيير في نفس المعاملة ويُرسل في الخلفية
+import os
+import asyncio
+import logging
+from psycopg.types.json import Jsonb
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from database import safe_db_execute, safe_db_fetchall
+from ratelimit import throttle
+from metrics import OUTBOX_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# مهلة حجز الرسالة؛ إن توقف العامل قبل الإرسال تعود متاحة بعدها (وتُجدَّد ما دامت الدفعة قيد الإرسال)
+OUTBOX_LEASE = 30
+# حد رسائل المحادثة الواحدة في الدفعة (رسالة/ث لكل محادثة)، فلا تطول دفعة بسبب محادثة واحدة
+OUTBOX_PER_CHAT = int(os.getenv("OUTBOX_PER_CHAT", "10"))
+
+ENQUEUE_SQL = """
+    INSERT INTO outbox (chat_id, kind, payload)
+    SELECT * FROM unnest(%s::bigint[], %s::text[], %s::jsonb[])
+"""
+
+_wake = asyncio.Event()
+
+
+# ---------------- بناء الرسائل ----------------
+def message(chat_id: int, text: str, parse_mode: str = "HTML", reply_markup: InlineKeyboardMarkup = None) -> dict:
+    payload = {"text": text, "parse_mode": parse_mode}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup.to_dict()
+    return {"chat_id": chat_id, "kind": "message", "payload": payload}
+
+def photo(chat_id: int, photo_id: str, caption: str, parse_mode: str = "HTML", reply_markup: InlineKeyboardMarkup = None) -> dict:
+    payload = {"photo": photo_id, "caption": caption, "parse_mode": parse_mode}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup.to_dict()
+    return {"chat_id": chat_id, "kind": "photo", "payload": payload}
+
+
+async def enqueue(messages: list[dict], conn=None):
+    """إضافة رسائل للصندوق؛ مع conn تُكتب ضمن معاملة العملية نفسها"""
+    if not messages:
+        return
+    params = (
+        [m["chat_id"] for m in messages],
+        [m["kind"] for m in messages],
+        [Jsonb(m["payload"]) for m in messages],
+    )
+    if conn is None:
+        await safe_db_execute(ENQUEUE_SQL, params)
+    else:
+        await conn.execute(ENQUEUE_SQL, params)
+
+def wake():
+    """إيقاظ العامل فورًا بعد commit بدل انتظار دورة الاستطلاع"""
+    _wake.set()
+
+
+# ---------------- العامل ----------------
+async def _claim() -> list:
+    return await safe_db_fetchall("""
+        UPDATE outbox SET next_attempt_at = NOW() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, row_number() OVER (PARTITION BY chat_id ORDER BY id) AS n
+                    FROM outbox
+                    WHERE status = 'PENDING' AND next_attempt_at <= NOW()
+                ) due WHERE n <= %s
+            )
+            ORDER BY id LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, chat_id, kind, payload, attempts
+    """, (OUTBOX_LEASE, OUTBOX_PER_CHAT, OUTBOX_BATCH))
+
+
+async def _renew(pending: set):
+    """تمديد حجز الرسائل التي لم تُرسل بعد (انتظار RetryAfter أو حد المحادثة) حتى لا يحجزها عامل آخر"""
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE / 3)
+        if pending:
+            await safe_db_execute(
+                "UPDATE outbox SET next_attempt_at = NOW() + make_interval(secs => %s) "
+                "WHERE id = ANY(%s) AND status = 'PENDING'",
+                (OUTBOX_LEASE, list(pending))
+            )
+
+
+async def _send(bot: Bot, row: dict):
+    p = row["payload"]
+    markup = InlineKeyboardMarkup.de_json(p["reply_markup"], bot) if p.get("reply_markup") else None
+    if row["kind"] == "photo":
+        await bot.send_photo(row["chat_id"], photo=p["photo"], caption=p.get("caption"),
+                             parse_mode=p.get("parse_mode"), reply_markup=markup)
+    else:
+        await bot.send_message(row["chat_id"], p["text"], parse_mode=p.get("parse_mode"), reply_markup=markup)
+
+
+async def _deliver(bot: Bot, row: dict, sem: asyncio.Semaphore, pending: set) -> int | None:
+    """إرسال رسالة واحدة؛ يُرجع id عند النجاح أو None إن أُعيدت جدولتها/فشلت"""
+    done = None
+    try:
+        done = await _deliver_one(bot, row, sem)
+        return done
+    finally:
+        # المُرسلة تبقى محجوزة حتى حذفها؛ غيرها أُعيدت جدولتها فلا تُمدد
+        if done is None:
+            pending.discard(row["id"])
+
+
+async def _deliver_one(bot: Bot, row: dict, sem: asyncio.Semaphore) -> int | None:
+    async with sem:
+        await throttle.wait(row["chat_id"])
+        try:
+            await _send(bot, row)
+            return row["id"]
+        except RetryAfter as e:
+            throttle.flood_wait(e.retry_after)
+            await safe_db_execute(
+                "UPDATE outbox SET next_attempt_at = NOW() + make_interval(secs => %s) WHERE id = %s",
+                (e.retry_after, row["id"])
+            )
+        except (Forbidden, BadRequest) as e:
+            await safe_db_execute(
+                "UPDATE outbox SET status = 'FAILED', last_error = %s WHERE id = %s", (str(e), row["id"])
+            )
+        except Exception as e:
+            attempts = row["attempts"] + 1
+            status = "FAILED" if attempts >= OUTBOX_MAX_ATTEMPTS else "PENDING"
+            await safe_db_execute("""
+                UPDATE outbox SET attempts = %s, status = %s, last_error = %s,
+                    next_attempt_at = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (attempts, status, str(e), min(2 ** attempts, 600), row["id"]))
+            logger.warning(f"Outbox #{row['id']} to {row['chat_id']} failed (attempt {attempts}): {e}")
+        return None
+
+
+async def run_worker(bot: Bot):
+    """تفريغ الصندوق باستمرار: حجز دفعة (SKIP LOCKED) ← إرسال متزامن منظّم المعدل ← حذف المُرسل"""
+    sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    logger.info("✅ Outbox worker started.")
+    while True:
+        try:
+            _wake.clear()
+            rows = await _claim()
+            if not rows:
+                try:
+                    await asyncio.wait_for(_wake.wait(), OUTBOX_POLL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            pending = {r["id"] for r in rows}
+            renewer = asyncio.create_task(_renew(pending))
+            try:
+                # نتيجة كل صف على حدة: خطأ قاعدة في إعادة جدولة صف لا يُضيّع حذف ما أُرسل فعلًا
+                results = await asyncio.gather(*(_deliver(bot, r, sem, pending) for r in rows), return_exceptions=True)
+                done, errors = [], 0
+                for r, res in zip(rows, results):
+                    if isinstance(res, Exception):
+                        # لم تُسجّل نتيجته؛ يخرج من التمديد فيعود متاحًا عند انتهاء الحجز
+                        errors += 1
+                        logger.error(f"Outbox #{r['id']} bookkeeping failed: {res}")
+                    elif res is not None:
+                        done.append(res)
+                OUTBOX_MESSAGES.inc("sent", amount=len(done))
+                OUTBOX_MESSAGES.inc("deferred", amount=len(rows) - len(done) - errors)
+                OUTBOX_MESSAGES.inc("error", amount=errors)
+                if done:
+                    # الحذف بالمعرفات آمن للإعادة، وفشله يعني إرسال هذه الرسائل مجددًا بعد انتهاء الحجز
+                    await safe_db_execute("DELETE FROM outbox WHERE id = ANY(%s)", (done,), idempotent=True)
+            finally:
+                renewer.cancel()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbox worker error: {e}")
+            await asyncio.sleep(OUTBOX_POLL)
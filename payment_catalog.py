@@ -0,0 +1,76 @@
+# payment_catalog.py — نسخة في الذاكرة من طرق الدفع مع لوحات الأزرار الجاهزة (تُعاد بناؤها عند أي تعديل)
+import asyncio
+import logging
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from database import safe_db_execute, safe_db_fetchall, on_notify
+from settings_cache import DB_NOTIFY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSnapshot:
+    """لقطة ثابتة لا تتغير بعد بنائها؛ القراء يحتفظون بها بأمان أثناء إعادة التحميل"""
+    __slots__ = ("version", "methods", "user_keyboard", "admin_keyboard")
+
+    def __init__(self, version: int, rows: list):
+        self.version = version
+        self.methods = {r["id"]: r for r in rows}
+        self.user_keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(r["name"], callback_data=f"paymethod:{r['id']}")] for r in rows]
+        ) if rows else None
+        buttons = [[InlineKeyboardButton("➕ إضافة طريقة دفع", callback_data="add_payment:new")]]
+        for r in rows:
+            buttons.append([
+                InlineKeyboardButton("✏️ تعديل", callback_data=f"edit_pm:{r['id']}"),
+                InlineKeyboardButton("🗑️ حذف", callback_data=f"del_pm:{r['id']}")
+            ])
+            buttons.append([InlineKeyboardButton(f"💳 {r['name']}", callback_data="cancel:op")])
+        buttons.append([InlineKeyboardButton("🔙 رجوع", callback_data="cancel:op")])
+        self.admin_keyboard = InlineKeyboardMarkup(buttons)
+
+
+class PaymentCatalog:
+    def __init__(self):
+        self._snapshot: CatalogSnapshot | None = None
+        self._version = 0
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+    def invalidate(self, arg: str = None):
+        """تعليم النسخة كقديمة (يُعاد التحميل عند القراءة التالية)"""
+        self._stale = True
+
+    async def load(self) -> CatalogSnapshot:
+        async with self._lock:
+            if self._stale or self._snapshot is None:
+                # نعلّم قبل الاستعلام حتى لا يضيع إبطال يصل أثناء التحميل
+                self._stale = False
+                try:
+                    rows = await safe_db_fetchall("SELECT id, name, barcode FROM payment_methods ORDER BY id")
+                except Exception:
+                    # تبقى النسخة قديمة فتُعاد المحاولة في القراءة التالية
+                    self._stale = True
+                    raise
+                self._version += 1
+                self._snapshot = CatalogSnapshot(self._version, rows)
+                logger.info(f"💳 Payment catalog v{self._version} loaded ({len(rows)} methods).")
+            return self._snapshot
+
+    async def current(self) -> CatalogSnapshot:
+        if self._stale or self._snapshot is None:
+            return await self.load()
+        return self._snapshot
+
+    async def changed(self):
+        """يُنادى بعد أي تعديل على payment_methods: إعادة بناء محلية وإبلاغ باقي النسخ"""
+        self.invalidate()
+        try:
+            await self.load()
+        finally:
+            # الإبلاغ يُرسل حتى لو فشلت إعادة التحميل المحلية؛ التعديل نفسه تم في القاعدة
+            if DB_NOTIFY_CHANNEL:
+                await safe_db_execute("SELECT pg_notify(%s, 'payment_methods')", (DB_NOTIFY_CHANNEL,))
+
+
+catalog = PaymentCatalog()
+on_notify("payment_methods", catalog.invalidate)
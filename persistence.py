@@ -0,0 +1,160 @@
+# persistence.py — حفظ حالة المحادثة (user_data) في Postgres مع كاش كتابة مؤجلة
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from psycopg.types.json import Jsonb
+from telegram.ext import BasePersistence, PersistenceInput
+from database import safe_db_execute, safe_db_fetchone
+
+logger = logging.getLogger(__name__)
+
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+STATE_IDLE_TTL = float(os.getenv("STATE_IDLE_TTL", "3600"))
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    تخزين user_data في جدول user_state:
+    - التحميل كسول: تُقرأ حالة المستخدم من القاعدة عند أول تحديث له فقط
+    - الكتابة مؤجلة: التغييرات تُجمع في الذاكرة وتُكتب دفعة واحدة كل STATE_FLUSH_INTERVAL
+    - المستخدمون الخاملون يُزالون من الذاكرة (LRU) بعد حفظ حالتهم
+    """
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=STATE_FLUSH_INTERVAL,
+        )
+        self._seen: OrderedDict[int, float] = OrderedDict()
+        self._loading: dict[int, asyncio.Task] = {}
+        self._dirty: dict[int, dict] = {}
+        self._evicted: set[int] = set()
+        self._flusher: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self.application = None
+
+    def attach(self, application):
+        """ربط الـ Application لإزالة المستخدمين الخاملين من user_data الخاص بها"""
+        self.application = application
+
+    # ---------- user_data ----------
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def _load(self, user_id: int):
+        row = await safe_db_fetchone("SELECT data FROM user_state WHERE user_id = %s", (user_id,))
+        return row["data"] if row else None
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id not in self._seen:
+            # PTB ينتظر هذا التحميل قبل أي معالج: تحديثات المستخدم الواحد تنتظر نفس المهمة فتُستأنف
+            # بترتيب وصولها، ولا يسبق تحديثٌ لاحق سابقه إلى user_lock لأن استعلامه انتهى أولًا
+            load = self._loading.get(user_id)
+            if load is None:
+                load = self._loading[user_id] = asyncio.create_task(self._load(user_id))
+                load.add_done_callback(lambda _: self._loading.pop(user_id, None))
+            data = await asyncio.shield(load)
+            if data and not user_data:
+                user_data.update(data)
+        self._seen[user_id] = time.monotonic()
+        self._seen.move_to_end(user_id)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._dirty[user_id] = data
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def drop_user_data(self, user_id: int):
+        if user_id in self._evicted:
+            # إزالة من الذاكرة فقط وليست حذفًا؛ إن عاد المستخدم قبل التنفيذ نعيد تعليم بياناته للحفظ
+            self._evicted.discard(user_id)
+            if user_id in self._seen and self.application:
+                self.application.mark_data_for_update_persistence(user_ids=user_id)
+            return
+        self._dirty.pop(user_id, None)
+        self._seen.pop(user_id, None)
+        await safe_db_execute("DELETE FROM user_state WHERE user_id = %s", (user_id,))
+
+    # ---------- write-behind ----------
+    async def _flush_dirty(self):
+        async with self._lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            keep = {uid: data for uid, data in batch.items() if data}
+            empty = [uid for uid, data in batch.items() if not data]
+            try:
+                if keep:
+                    await safe_db_execute("""
+                        INSERT INTO user_state (user_id, data, updated_at)
+                        SELECT u, d, NOW() FROM unnest(%s::bigint[], %s::jsonb[]) AS t(u, d)
+                        ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+                    """, (list(keep), [Jsonb(d) for d in keep.values()]))
+                if empty:
+                    await safe_db_execute("DELETE FROM user_state WHERE user_id = ANY(%s)", (empty,))
+            except Exception as e:
+                # إعادة الدفعة للمحاولة لاحقًا دون الكتابة فوق تغييرات أحدث
+                for uid, data in batch.items():
+                    self._dirty.setdefault(uid, data)
+                logger.error(f"State flush failed ({len(batch)} users): {e}")
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self._seen:
+            uid, last = next(iter(self._seen.items()))
+            if len(self._seen) <= STATE_CACHE_SIZE and now - last < STATE_IDLE_TTL:
+                break
+            if uid in self._dirty or self.application is None:
+                # لم تُحفظ بعد؛ تبقى حتى الدورة التالية
+                break
+            self._seen.popitem(last=False)
+            self._evicted.add(uid)
+            self.application.drop_user_data(uid)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            await self._flush_dirty()
+            self._evict_idle()
+
+    async def flush(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self._flush_dirty()
+
+    # ---------- غير مستخدمة ----------
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
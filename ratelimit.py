@@ -0,0 +1,76 @@
+# ratelimit.py — تنظيم معدل الإرسال وفق حدود Telegram (عام + لكل محادثة)
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+# حدود Telegram: ~30 رسالة/ث إجمالًا، ورسالة واحدة/ث لكل محادثة
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+PER_CHAT_RATE = float(os.getenv("TG_PER_CHAT_RATE", "1"))
+MAX_TRACKED_CHATS = 10_000
+
+
+class TokenBucket:
+    """دلو رموز: يسمح بـ rate عملية في الثانية مع دفعة أقصاها capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """إيقاف السحب مؤقتًا (مثلًا عند RetryAfter) وتفريغ الدلو"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Throttle:
+    """يجمع دلوًا عامًا مع دلو لكل محادثة (بحد أقصى لعدد المحادثات المتتبعة)"""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE):
+        self.global_bucket = TokenBucket(global_rate)
+        self._per_chat_rate = per_chat_rate
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._per_chat_rate, 1.0)
+            if len(self._chats) > MAX_TRACKED_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def wait(self, chat_id: int):
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def flood_wait(self, seconds: float):
+        """تطبيق RetryAfter على كل الإرسال (الحظر من Telegram عام على البوت)"""
+        self.global_bucket.pause(seconds)
+
+
+# منظّم واحد مشترك لكل المرسلين في العملية (الصندوق الصادر والبث) حتى لا يتجاوز مجموعهم الحد العام
+throttle = Throttle()
@@ -0,0 +1,99 @@
+# referral_stats.py — تحليلات الإحالة من عروض مادية (materialized views) تُحدَّث دوريًا بـ CONCURRENTLY
+import os
+import logging
+from telegram.ext import ContextTypes, JobQueue
+from database import safe_db_fetchone, safe_db_fetchall, transaction
+
+logger = logging.getLogger(__name__)
+
+REFERRAL_REFRESH_INTERVAL = float(os.getenv("REFERRAL_REFRESH_INTERVAL", "600"))
+REFERRAL_TREE_MAX_DEPTH = int(os.getenv("REFERRAL_TREE_MAX_DEPTH", "5"))
+# مفتاح قفل استشاري حتى لا تحدّث نسختان العروض في نفس الوقت
+REFRESH_LOCK_KEY = 7_310_2027
+
+LEADERBOARD_SQL = """
+    SELECT s.referrer_id, u.username, s.referred, s.paid, s.earned
+    FROM referral_stats s
+    LEFT JOIN users u ON u.telegram_id = s.referrer_id
+    ORDER BY s.paid DESC, s.referred DESC
+    LIMIT %s
+"""
+
+TOTALS_SQL = """
+    SELECT COALESCE(sum(referred), 0) AS referred, COALESCE(sum(paid), 0) AS paid,
+           COALESCE(sum(earned), 0) AS earned, count(*) AS referrers
+    FROM referral_stats
+"""
+
+# شجرة متعددة المستويات مجمّعة حسب العمق؛ path يمنع الحلقات
+TREE_SQL = """
+    WITH RECURSIVE tree AS (
+        SELECT telegram_id, paid, 1 AS depth, ARRAY[telegram_id] AS path
+        FROM referral_edges WHERE referrer_id = %(root)s
+        UNION ALL
+        SELECT e.telegram_id, e.paid, t.depth + 1, t.path || e.telegram_id
+        FROM referral_edges e JOIN tree t ON e.referrer_id = t.telegram_id
+        WHERE t.depth < %(depth)s AND e.telegram_id <> ALL(t.path)
+    )
+    SELECT depth, count(*) AS users, count(*) FILTER (WHERE paid) AS paid
+    FROM tree GROUP BY depth ORDER BY depth
+"""
+
+
+def _rate(paid, referred) -> str:
+    return f"{paid / referred * 100:.1f}%" if referred else "---"
+
+
+async def refresh(context: ContextTypes.DEFAULT_TYPE = None):
+    """تحديث العروض دون حجب القراءات؛ يُتخطى إن كانت نسخة أخرى تحدّثها الآن"""
+    try:
+        async with transaction() as conn:
+            cur = await conn.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (REFRESH_LOCK_KEY,))
+            if not (await cur.fetchone())["locked"]:
+                return
+            # referral_stats مبني على referral_edges، فتُحدَّث الحواف أولًا
+            await conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY referral_edges")
+            await conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY referral_stats")
+    except Exception as e:
+        logger.error(f"Referral stats refresh failed: {e}")
+
+
+def schedule(job_queue: JobQueue | None):
+    if job_queue is None:
+        return
+    job_queue.run_repeating(refresh, interval=REFERRAL_REFRESH_INTERVAL, first=60, name="referral_stats")
+
+
+async def leaderboard_text(n: int = 10) -> str:
+    totals = await safe_db_fetchone(TOTALS_SQL)
+    rows = await safe_db_fetchall(LEADERBOARD_SQL, (n,))
+    lines = [
+        "📈 إحصاءات الإحالة",
+        f"👥 المُحالون: {totals['referred']} | ✅ المشتركون: {totals['paid']} "
+        f"| 🔁 التحويل: {_rate(totals['paid'], totals['referred'])}",
+        f"💰 إجمالي العمولات: {totals['earned']}$ | 🧑‍🤝‍🧑 المُحيلون: {totals['referrers']}",
+        "",
+        f"🏆 أفضل {n} مُحيلين:",
+    ]
+    for i, r in enumerate(rows, 1):
+        name = f"@{r['username']}" if r["username"] else r["referrer_id"]
+        lines.append(
+            f"{i}. {name} — {r['paid']}/{r['referred']} ({_rate(r['paid'], r['referred'])}) — {r['earned']}$"
+        )
+    if not rows:
+        lines.append("---")
+    return "\n".join(lines)
+
+
+async def tree_text(root: int, depth: int = REFERRAL_TREE_MAX_DEPTH) -> str:
+    depth = max(1, min(depth, REFERRAL_TREE_MAX_DEPTH))
+    stats = await safe_db_fetchone("SELECT * FROM referral_stats WHERE referrer_id = %s", (root,))
+    levels = await safe_db_fetchall(TREE_SQL, {"root": root, "depth": depth})
+    lines = [f"🌳 شجرة إحالات {root} (حتى {depth} مستويات)"]
+    if stats:
+        lines.append(f"💰 العمولات: {stats['earned']}$ | 🔁 التحويل المباشر: {_rate(stats['paid'], stats['referred'])}")
+    for lvl in levels:
+        lines.append(f"المستوى {lvl['depth']}: {lvl['users']} مستخدم، {lvl['paid']} مشترك")
+    if not levels:
+        lines.append("---")
+    return "\n".join(lines)
@@ -0,0 +1,82 @@
+# registration.py — تجميع تسجيلات /start في الذاكرة وكتابتها دفعة واحدة كل نافذة قصيرة
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from database import safe_db_execute
+
+logger = logging.getLogger(__name__)
+
+REGISTER_FLUSH_INTERVAL = float(os.getenv("REGISTER_FLUSH_INTERVAL", "0.5"))
+REGISTER_BATCH = int(os.getenv("REGISTER_BATCH", "500"))
+KNOWN_USERS_CACHE = int(os.getenv("KNOWN_USERS_CACHE", "100000"))
+
+
+class RegistrationBuffer:
+    """
+    - المستخدمون المعروفون (LRU محدود) لا يُكتبون مجددًا
+    - الجدد يُجمعون ويُدرجون كل REGISTER_FLUSH_INTERVAL (أو فور بلوغ REGISTER_BATCH) بإدراج واحد متعدد الصفوف
+    - قاعدة المُحيل كما هي: أول تسجيل هو الذي يُعتمد (ON CONFLICT DO NOTHING)
+    """
+
+    def __init__(self):
+        self._known: OrderedDict[int, None] = OrderedDict()
+        self._pending: dict[int, tuple] = {}
+        self._full = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def register(self, user_id: int, username: str | None, referrer_id: int | None):
+        if user_id in self._known:
+            self._known.move_to_end(user_id)
+            return
+        # setdefault: أول /start داخل النافذة هو الذي يحدد المُحيل، تمامًا كما في القاعدة
+        self._pending.setdefault(user_id, (username, referrer_id))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= REGISTER_BATCH:
+            self._full.set()
+
+    def _remember(self, ids):
+        for uid in ids:
+            self._known[uid] = None
+            self._known.move_to_end(uid)
+        while len(self._known) > KNOWN_USERS_CACHE:
+            self._known.popitem(last=False)
+
+    async def flush(self) -> bool:
+        """كتابة المعلّق؛ False إن فشلت الكتابة (يبقى المعلّق للمحاولة التالية)"""
+        async with self._lock:
+            if not self._pending:
+                return True
+            batch, self._pending = self._pending, {}
+            try:
+                await safe_db_execute("""
+                    INSERT INTO users (telegram_id, username, referrer_id)
+                    SELECT * FROM unnest(%s::bigint[], %s::text[], %s::bigint[])
+                    ON CONFLICT (telegram_id) DO NOTHING
+                """, (list(batch), [v[0] for v in batch.values()], [v[1] for v in batch.values()]))
+            except Exception as e:
+                for uid, v in batch.items():
+                    self._pending.setdefault(uid, v)
+                logger.error(f"Registration flush failed ({len(batch)} users): {e}")
+                return False
+            self._remember(batch)
+            return True
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), REGISTER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
+
+
+registrations = RegistrationBuffer()
@@ -0,0 +1,115 @@
+# router.py — توجيه أزرار inline عبر جدول (action → handler) بدل سلسلة if/elif
+import re
+import time
+import logging
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ContextTypes
+from metrics import HANDLER_LATENCY, HANDLER_ERRORS
+from user_lock import UserLock
+import idempotency
+
+logger = logging.getLogger(__name__)
+
+
+def parse_callback(data: str):
+    try:
+        parts = data.split(":", 2)
+        action = parts[0]
+        id_val = parts[1] if len(parts) > 1 else None
+        extra = parts[2] if len(parts) > 2 else None
+        return action, id_val, extra
+    except:
+        return None, None, None
+
+
+class CallbackRouter:
+    """
+    يسجّل كل action بمزخرف route() مع حارس أدمن اختياري، ويُنتج CallbackQueryHandler
+    مستقلًا لكل مسار (pattern=^action(:|$)) حتى يُقاس كل مسار على حدة.
+    المسارات idempotent تُرجع نص نتيجتها، والضغطات المتكررة تُجاب به دون تنفيذ المسار مجددًا.
+    """
+
+    def __init__(self, admins: frozenset):
+        self.admins = admins
+        self.routes: dict[str, tuple] = {}
+
+    def route(self, action: str, admin: bool = False, idempotent: bool = False):
+        def decorator(func):
+            self.routes[action] = (func, admin, idempotent)
+            return func
+        return decorator
+
+    async def _run(self, action: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # التحديثات تصل هنا بترتيب وصولها: لا await قبل المعالج سوى refresh_data، وتحميلات المستخدم
+        # الواحد فيه مهمة مشتركة (persistence.py)؛ فيأخذ القفل بنفس الترتيب ويُنفَّذ واحدًا تلو الآخر
+        async with UserLock(update.callback_query.from_user.id):
+            await self._run_locked(action, update, context)
+
+    async def _run_locked(self, action: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        func, admin, idempotent = self.routes[action]
+        _, id_val, extra = parse_callback(q.data)
+        key = idempotency.action_key(update, action, id_val) if idempotent else None
+        if key is not None:
+            cached = idempotency.cached_result(key)
+            if cached is not None:
+                await q.answer(cached)
+                return
+        await q.answer()
+        if admin and q.from_user.id not in self.admins:
+            return
+        started, failed = time.perf_counter(), False
+        try:
+            result = await func(update, context, id_val, extra)
+            if key is not None and result is not None:
+                idempotency.remember(key, result)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe("callback", action, value=elapsed)
+            if failed:
+                HANDLER_ERRORS.inc("callback", action)
+
+    def _handler_for(self, action: str):
+        async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            await self._run(action, update, context)
+        handler.__name__ = f"route_{action}"
+        return handler
+
+    async def _unknown(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
+        await q.message.reply_text("❌ طلب غير صالح.")
+
+    def handlers(self) -> list:
+        """معالج مستقل لكل مسار، ثم معالج أخير للبيانات غير المعروفة"""
+        handlers = [
+            CallbackQueryHandler(self._handler_for(action), pattern=re.compile(rf"^{re.escape(action)}(:|$)"))
+            for action in self.routes
+        ]
+        handlers.append(CallbackQueryHandler(self._unknown))
+        return handlers
+
+    def report(self) -> str:
+        """ملخص المسارات من مدرج HANDLER_LATENCY نفسه (p95 تقريبي: حد السلة التي تبلغها)"""
+        stats = [
+            (action, s) for (kind, action), s in HANDLER_LATENCY.series.items()
+            if kind == "callback" and action in self.routes
+        ]
+        lines = []
+        for action, s in sorted(stats, key=lambda kv: -kv[1][-1]):
+            calls = sum(s[:-1])
+            seen, p95 = 0, "+Inf"
+            for bound, n in zip(HANDLER_LATENCY.buckets, s):
+                seen += n
+                if seen >= calls * 0.95:
+                    p95 = f"{bound * 1000:.0f}ms"
+                    break
+            errors = HANDLER_ERRORS.series.get(("callback", action), 0)
+            lines.append(
+                f"{action}: {calls} × avg {s[-1] / calls * 1000:.1f}ms, "
+                f"p95 ≤ {p95}, errors {errors}"
+            )
+        return "\n".join(lines) or "---"
@@ -0,0 +1,78 @@
+# settings_cache.py — كاش الإعدادات في الذاكرة مع إبطال فوري عند التعديل
+import os
+import time
+import asyncio
+import logging
+from database import safe_db_fetchall, safe_db_execute, on_notify
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_TTL = float(os.getenv("SETTINGS_TTL", "300"))
+# قناة NOTIFY اختيارية لمزامنة الكاش بين عدة نسخ من البوت
+DB_NOTIFY_CHANNEL = os.getenv("DB_NOTIFY_CHANNEL")
+
+DEFAULTS = {"subscription_price": "5", "referral_reward": "1", "min_withdraw": "2", "subscription_days": "30"}
+
+
+class SettingsCache:
+    """يحمّل جدول settings كاملًا باستعلام واحد ويخدم القراءات من الذاكرة حتى انتهاء الـ TTL"""
+
+    def __init__(self, ttl: float = SETTINGS_TTL):
+        self._ttl = ttl
+        self._values: dict[str, str] = {}
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self._ttl
+
+    def invalidate(self, key: str = None):
+        """إبطال الكاش (يُعاد التحميل عند القراءة التالية)"""
+        self._loaded_at = None
+
+    async def load(self):
+        """تحميل جميع الإعدادات باستعلام واحد"""
+        async with self._lock:
+            if self._fresh():
+                return
+            rows = await safe_db_fetchall("SELECT key, value FROM settings")
+            self._values = {r["key"]: r["value"] for r in rows}
+            self._loaded_at = time.monotonic()
+
+    async def get(self, key: str) -> str:
+        if not self._fresh():
+            await self.load()
+        return self._values.get(key, DEFAULTS.get(key))
+
+    async def get_int(self, key: str) -> int:
+        return int(float(await self.get(key)))
+
+    async def get_float(self, key: str) -> float:
+        return float(await self.get(key))
+
+    async def all(self) -> dict[str, str]:
+        if not self._fresh():
+            await self.load()
+        return {**DEFAULTS, **self._values}
+
+    async def set(self, key: str, value: str):
+        """حفظ قيمة وإبطال الكاش محليًا وعلى باقي النسخ عبر NOTIFY"""
+        if DB_NOTIFY_CHANNEL:
+            await safe_db_execute("""
+                WITH up AS (
+                    INSERT INTO settings (key, value) VALUES (%s, %s)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                    RETURNING key
+                )
+                SELECT pg_notify(%s, 'settings:' || key) FROM up
+            """, (key, value, DB_NOTIFY_CHANNEL))
+        else:
+            await safe_db_execute(
+                "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                (key, value)
+            )
+        self.invalidate(key)
+
+
+settings = SettingsCache()
+on_notify("settings", settings.invalidate)
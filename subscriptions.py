@@ -0,0 +1,88 @@
+# subscriptions.py — مهمة دورية لإنهاء الاشتراكات المنتهية وتذكير من اقترب انتهاؤه (عبر JobQueue)
+import os
+import logging
+from telegram.ext import ContextTypes, JobQueue
+from database import safe_db_fetchone
+import outbox
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_CHECK_INTERVAL = float(os.getenv("SUBSCRIPTION_CHECK_INTERVAL", "3600"))
+# عدد الأيام قبل الانتهاء التي يُرسل فيها التذكير
+SUBSCRIPTION_REMIND_DAYS = int(os.getenv("SUBSCRIPTION_REMIND_DAYS", "3"))
+# حد الصفوف في كل استعلام حتى تبقى المعاملة قصيرة مهما كثرت الاشتراكات المستحقة
+SUBSCRIPTION_BATCH = int(os.getenv("SUBSCRIPTION_BATCH", "1000"))
+
+EXPIRED_TEXT = "⌛ انتهى اشتراكك في القناة.\nجدّد الاشتراك من القائمة للاستمرار."
+# %s = تاريخ الانتهاء (يُملأ داخل القاعدة بـ format)
+REMINDER_TEXT = "⏰ ينتهي اشتراكك بتاريخ %s.\nجدّد الآن حتى لا ينقطع وصولك للقناة."
+
+# إنهاء دفعة من الاشتراكات وإضافة إشعاراتها للصندوق الصادر في نفس الاستعلام
+EXPIRE_SQL = """
+    WITH expired AS (
+        UPDATE users SET subscription_active = FALSE
+        WHERE id IN (
+            SELECT id FROM users
+            WHERE subscription_active AND subscription_end < CURRENT_DATE
+            ORDER BY subscription_end LIMIT %(batch)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING telegram_id
+    ), notify AS (
+        INSERT INTO outbox (chat_id, kind, payload)
+        SELECT telegram_id, 'message', jsonb_build_object('text', %(text)s::text) FROM expired
+    )
+    SELECT count(*) AS n FROM expired
+"""
+
+# تذكير واحد لكل فترة اشتراك؛ renewal_reminded يُعاد ضبطه عند التجديد
+REMIND_SQL = """
+    WITH due AS (
+        UPDATE users SET renewal_reminded = TRUE
+        WHERE id IN (
+            SELECT id FROM users
+            WHERE subscription_active AND NOT renewal_reminded
+              AND subscription_end >= CURRENT_DATE
+              AND subscription_end <= CURRENT_DATE + %(days)s::int
+            ORDER BY subscription_end LIMIT %(batch)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING telegram_id, subscription_end
+    ), notify AS (
+        INSERT INTO outbox (chat_id, kind, payload)
+        SELECT telegram_id, 'message',
+               jsonb_build_object('text', format(%(text)s::text, to_char(subscription_end, 'YYYY-MM-DD')))
+        FROM due
+    )
+    SELECT count(*) AS n FROM due
+"""
+
+
+async def _drain(query: str, params: dict) -> int:
+    """تكرار الاستعلام حتى تُعالج كل الصفوف المستحقة"""
+    total = 0
+    while True:
+        row = await safe_db_fetchone(query, {**params, "batch": SUBSCRIPTION_BATCH})
+        total += row["n"]
+        if row["n"] < SUBSCRIPTION_BATCH:
+            return total
+
+
+async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        reminded = await _drain(REMIND_SQL, {"days": SUBSCRIPTION_REMIND_DAYS, "text": REMINDER_TEXT})
+        expired = await _drain(EXPIRE_SQL, {"text": EXPIRED_TEXT})
+    except Exception as e:
+        logger.error(f"Subscription check failed: {e}")
+        return
+    if reminded or expired:
+        outbox.wake()
+        logger.info(f"🗓️ Subscriptions: {expired} expired, {reminded} reminded")
+
+
+def schedule(job_queue: JobQueue | None):
+    if job_queue is None:
+        logger.warning("⚠️ JobQueue unavailable (install python-telegram-bot[job-queue]); subscriptions will not expire.")
+        return
+    job_queue.run_repeating(check_subscriptions, interval=SUBSCRIPTION_CHECK_INTERVAL, first=30,
+                            name="subscriptions")
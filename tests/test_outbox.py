@@ -0,0 +1,42 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/unused")
+
+import outbox  # noqa: E402
+
+
+def test_sent_rows_are_deleted_when_another_row_fails(monkeypatch):
+    rows = [{"id": 1, "chat_id": 10}, {"id": 2, "chat_id": 20}, {"id": 3, "chat_id": 30}]
+    deleted, claims = [], []
+
+    async def claim():
+        # دفعة واحدة ثم إيقاف العامل
+        claims.append(1)
+        if len(claims) > 1:
+            raise asyncio.CancelledError
+        return rows
+
+    async def deliver(bot, row, sem, pending):
+        if row["id"] == 2:
+            # فشل UPDATE إعادة الجدولة بعد رفض الإرسال
+            pending.discard(2)
+            raise RuntimeError("connection lost")
+        return row["id"]
+
+    async def execute(query, params, idempotent=False):
+        assert query.startswith("DELETE") and idempotent
+        deleted.extend(params[0])
+
+    monkeypatch.setattr(outbox, "_claim", claim)
+    monkeypatch.setattr(outbox, "_deliver", deliver)
+    monkeypatch.setattr(outbox, "safe_db_execute", execute)
+    monkeypatch.setattr(outbox, "OUTBOX_POLL", 0)
+
+    try:
+        asyncio.run(outbox.run_worker(None))
+    except asyncio.CancelledError:
+        pass
+    assert deleted == [1, 3]
@@ -0,0 +1,37 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/unused")
+
+import persistence  # noqa: E402
+
+
+def test_same_user_loads_resume_in_arrival_order(monkeypatch):
+    # الاستعلام الأول أبطأ من الثاني؛ بلا مهمة مشتركة كان التحديث الثاني يسبق الأول إلى المعالج
+    delays = [0.05, 0.0]
+    calls = []
+
+    async def fetchone(query, params):
+        calls.append(params)
+        await asyncio.sleep(delays[len(calls) - 1])
+        return {"data": {"step": 1}}
+
+    monkeypatch.setattr(persistence, "safe_db_fetchone", fetchone)
+
+    async def main():
+        p = persistence.PostgresPersistence()
+        user_data, order = {}, []
+
+        async def update(n):
+            await p.refresh_user_data(42, user_data)
+            order.append(n)
+
+        await asyncio.gather(update(1), update(2))
+        return order, user_data
+
+    order, user_data = asyncio.run(main())
+    assert order == [1, 2]
+    assert calls == [(42,)]
+    assert user_data == {"step": 1}
@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/unused")
+
+import update_queue  # noqa: E402
+
+
+def _claimant(key: int, count: int) -> list[int]:
+    bucket = update_queue.bucket_of(key)
+    return [i for i in range(count) if bucket in update_queue.buckets_for(i, count)]
+
+
+def test_negative_chat_id_is_claimed_and_notified():
+    # منشورات القنوات والمجموعات بلا effective_user: المفتاح معرّف المحادثة السالب
+    for key in (-1001234567890, -1, -1024, -1025):
+        bucket = update_queue.bucket_of(key)
+        assert 0 <= bucket < update_queue.UPDATE_QUEUE_BUCKETS
+        for count in (1, 2, 3, 7):
+            claimants = _claimant(key, count)
+            assert claimants == [update_queue.worker_of(bucket, count)]
+
+
+def test_every_bucket_has_exactly_one_worker():
+    for count in (1, 4, 5):
+        seen = sorted(b for i in range(count) for b in update_queue.buckets_for(i, count))
+        assert seen == list(range(update_queue.UPDATE_QUEUE_BUCKETS))
+
+
+def test_user_key_falls_back_to_chat():
+    class Chat:
+        id = -1009876543210
+
+    class U:
+        effective_user = None
+        effective_chat = Chat()
+
+    assert update_queue.user_key(U()) == Chat.id
@@ -0,0 +1,160 @@
+# update_queue.py — وضع متعدد العمال: مدخل (webhook/polling) يكتب التحديثات في Postgres وعمال يعالجونها
+#
+# BOT_ROLE=all     (الافتراضي) عملية واحدة تستقبل وتعالج كما كانت
+# BOT_ROLE=ingress يستقبل التحديثات ويكتبها في update_queue فقط
+# BOT_ROLE=worker  يعالج سلاله من الطابور: bucket % WORKER_COUNT == WORKER_INDEX
+# كل مستخدم في سلة ثابتة (bucket_of)، فيُعالج دائمًا في نفس العامل وبترتيب وصول تحديثاته وتبقى حالته
+# في ذاكرة عامل واحد. تغيير WORKER_COUNT يعيد توزيع السلال دون صفوف عالقة؛ غيّره بإعادة تشغيل كل العمال
+# معًا (workers.py يفعل ذلك) حتى لا يعمل عاملان بعددين مختلفين على نفس المستخدم.
+import os
+import signal
+import asyncio
+import logging
+from psycopg.types.json import Jsonb
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes
+from database import safe_db_execute, safe_db_fetchall, on_notify
+from registration import registrations
+from settings_cache import DB_NOTIFY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+UPDATE_QUEUE_BATCH = int(os.getenv("UPDATE_QUEUE_BATCH", "100"))
+UPDATE_QUEUE_POLL = float(os.getenv("UPDATE_QUEUE_POLL", "1"))
+# عدد السلال الثابت؛ الحد الأعلى لعدد العمال
+UPDATE_QUEUE_BUCKETS = 1024
+# مهلة الحجز؛ إن توقف العامل أثناء المعالجة تعود الدفعة متاحة بعدها (معالجة مرة واحدة على الأقل)
+UPDATE_QUEUE_LEASE = 60
+
+_wake = asyncio.Event()
+
+
+def is_primary() -> bool:
+    """النسخة التي تشغّل المهام الفردية (استئناف البث، المهام الدورية)"""
+    return BOT_ROLE == "all" or (BOT_ROLE == "worker" and WORKER_INDEX == 0)
+
+
+def user_key(update: Update) -> int:
+    """المستخدم، أو المحادثة لتحديثات القنوات والمجموعات (معرّفها سالب)"""
+    return update.effective_user.id if update.effective_user else (
+        update.effective_chat.id if update.effective_chat else 0
+    )
+
+
+def bucket_of(key: int) -> int:
+    # باقي القسمة في Python غير سالب حتى للمعرفات السالبة (بخلاف % في Postgres)
+    return key % UPDATE_QUEUE_BUCKETS
+
+
+def worker_of(bucket: int, count: int = WORKER_COUNT) -> int:
+    return bucket % count
+
+
+def buckets_for(index: int = WORKER_INDEX, count: int = WORKER_COUNT) -> list[int]:
+    """السلال التي يحجزها العامل index من count"""
+    return [b for b in range(UPDATE_QUEUE_BUCKETS) if worker_of(b, count) == index]
+
+
+# ---------------- INGRESS ----------------
+async def enqueue_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """TypeHandler في المجموعة -1: يحفظ التحديث كما هو ويوقف أي معالجة محلية"""
+    key = user_key(update)
+    bucket = bucket_of(key)
+    await safe_db_execute("""
+        WITH ins AS (
+            INSERT INTO update_queue (bucket, user_key, update_id, payload) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (update_id) DO NOTHING
+            RETURNING 1
+        )
+        SELECT pg_notify(%s, %s) FROM ins
+    """, (bucket, key, update.update_id, Jsonb(update.to_dict()),
+          DB_NOTIFY_CHANNEL, f"updates:{worker_of(bucket)}"))
+    raise ApplicationHandlerStop
+
+
+# ---------------- WORKER ----------------
+_my_buckets = buckets_for()
+
+
+def _on_updates(arg: str = None):
+    if arg is None or arg == str(WORKER_INDEX):
+        _wake.set()
+
+
+async def _claim() -> list:
+    return await safe_db_fetchall("""
+        UPDATE update_queue SET locked_until = NOW() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM update_queue
+            WHERE bucket = ANY(%s) AND locked_until <= NOW()
+            ORDER BY id LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_key, payload
+    """, (UPDATE_QUEUE_LEASE, _my_buckets, UPDATE_QUEUE_BATCH))
+
+
+async def _process_group(app: Application, rows: list):
+    for r in rows:
+        # أخطاء المعالجات تذهب لمعالج الأخطاء المسجّل ولا توقف الدفعة
+        await app.process_update(Update.de_json(r["payload"], app.bot))
+
+
+async def process_queue(app: Application, stop: asyncio.Event):
+    """معالجة دفعات السلال عبر معالجات البوت نفسها ثم حذفها"""
+    logger.info(f"✅ Worker {WORKER_INDEX}/{WORKER_COUNT} consuming update_queue.")
+    while not stop.is_set():
+        try:
+            _wake.clear()
+            rows = await _claim()
+            if not rows:
+                try:
+                    await asyncio.wait_for(_wake.wait(), UPDATE_QUEUE_POLL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # المستخدمون بالتوازي، وتحديثات كل مستخدم بترتيب id داخل مهمته
+            groups: dict[int, list] = {}
+            for r in sorted(rows, key=lambda r: r["id"]):
+                groups.setdefault(r["user_key"], []).append(r)
+            results = await asyncio.gather(
+                *(_process_group(app, g) for g in groups.values()), return_exceptions=True
+            )
+            for e in results:
+                if isinstance(e, Exception):
+                    logger.error(f"Worker {WORKER_INDEX} update failed: {e}")
+            # التسجيلات المجمعة تُكتب قبل حذف التحديثات التي أنتجتها، وإلا ضاعت عند انهيار العامل
+            if not await registrations.flush():
+                raise RuntimeError("registration flush failed; batch left for retry")
+            await safe_db_execute("DELETE FROM update_queue WHERE id = ANY(%s)", ([r["id"] for r in rows],))
+        except Exception as e:
+            logger.error(f"Worker {WORKER_INDEX} error: {e}")
+            await asyncio.sleep(UPDATE_QUEUE_POLL)
+
+
+async def _run_worker(app: Application):
+    if not 0 <= WORKER_INDEX < WORKER_COUNT <= UPDATE_QUEUE_BUCKETS:
+        raise RuntimeError(f"❌ Invalid WORKER_INDEX/WORKER_COUNT ({WORKER_INDEX}/{WORKER_COUNT})!")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    on_notify("updates", _on_updates)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        await process_queue(app, stop)
+    finally:
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+
+def run_worker(app: Application):
+    asyncio.run(_run_worker(app))
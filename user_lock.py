@@ -0,0 +1,63 @@
+# user_lock.py — قفل لكل مستخدم يحفظ ترتيب تحديثاته عند المعالجة المتوازية (concurrent_updates)
+#
+# PTB ينشئ مهمة لكل تحديث بترتيب الوصول، وasyncio.Lock يوقظ المنتظرين بنفس الترتيب (FIFO)،
+# فتحديثات المستخدم الواحد تُنفذ واحدًا تلو الآخر بينما يُعالج باقي المستخدمين بالتوازي.
+import asyncio
+import functools
+
+_locks: dict[int, asyncio.Lock] = {}
+# عدد المهام التي تحمل القفل أو تنتظره؛ يُحذف القفل عند الصفر حتى لا تكبر الذاكرة مع عدد المستخدمين
+_holders: dict[int, int] = {}
+
+
+def _user_id(update) -> int | None:
+    user = getattr(update, "effective_user", None)
+    return user.id if user else None
+
+
+class UserLock:
+    """async with UserLock(uid): ... — تسلسل العمل الخاص بمستخدم واحد"""
+    __slots__ = ("uid", "lock")
+
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.lock = _locks.get(uid)
+        if self.lock is None:
+            self.lock = _locks[uid] = asyncio.Lock()
+
+    async def __aenter__(self):
+        _holders[self.uid] = _holders.get(self.uid, 0) + 1
+        try:
+            await self.lock.acquire()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    async def __aexit__(self, *exc):
+        self.lock.release()
+        self._release_slot()
+
+    def _release_slot(self):
+        n = _holders[self.uid] - 1
+        if n:
+            _holders[self.uid] = n
+        else:
+            del _holders[self.uid]
+            _locks.pop(self.uid, None)
+
+
+def per_user(func):
+    """مزخرف لمعالج PTB (update, context, ...) ينفذه تحت قفل مستخدم التحديث"""
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        uid = _user_id(update)
+        if uid is None:
+            return await func(update, context, *args, **kwargs)
+        async with UserLock(uid):
+            return await func(update, context, *args, **kwargs)
+    return wrapper
+
+
+def active() -> int:
+    """عدد المستخدمين الذين لديهم تحديث قيد التنفيذ أو الانتظار"""
+    return len(_locks)
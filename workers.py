@@ -0,0 +1,81 @@
+# workers.py — تشغيل محلي لوضع العمال المتعددين: مدخل واحد + N عمال على نفس قاعدة البيانات
+#
+#   DATABASE_URL=... BOT_TOKEN=... python workers.py --workers 4
+#
+# كل عملية هي jetoor.py نفسه مع BOT_ROLE/WORKER_INDEX مختلفين؛ العملية المتوقفة تُعاد بتأخير متزايد،
+# و SIGINT/SIGTERM يُمرَّر للجميع. إن ضُبط METRICS_PORT تأخذ كل عملية منفذًا خاصًا بها (المنفذ + الترتيب).
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import logging
+
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger("workers")
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jetoor.py")
+MAX_BACKOFF = 30
+
+
+def _env(role: str, index: int, count: int) -> dict:
+    env = dict(os.environ, BOT_ROLE=role, WORKER_INDEX=str(index), WORKER_COUNT=str(count))
+    base_port = int(os.getenv("METRICS_PORT", "0"))
+    if base_port:
+        env["METRICS_PORT"] = str(base_port + (0 if role == "ingress" else index + 1))
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one ingress and N update workers")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKER_COUNT", "2")))
+    args = parser.parse_args()
+
+    specs = [("ingress", 0)] + [("worker", i) for i in range(args.workers)]
+    procs: dict[tuple, subprocess.Popen] = {}
+    backoff = {spec: 1 for spec in specs}
+    restart_at = {spec: 0.0 for spec in specs}
+    started = {spec: 0.0 for spec in specs}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        now = time.monotonic()
+        for spec in specs:
+            p = procs.get(spec)
+            if p is not None and p.poll() is None:
+                continue
+            if p is not None:
+                if now - started[spec] > 60:
+                    backoff[spec] = 1
+                logger.warning(f"⚠️ {spec[0]} {spec[1]} exited with {p.returncode}; restarting in {backoff[spec]}s")
+                restart_at[spec] = now + backoff[spec]
+                backoff[spec] = min(backoff[spec] * 2, MAX_BACKOFF)
+                procs.pop(spec)
+                continue
+            if now >= restart_at[spec]:
+                procs[spec] = subprocess.Popen([sys.executable, SCRIPT], env=_env(*spec, args.workers))
+                started[spec] = now
+                logger.info(f"🚀 Started {spec[0]} {spec[1]} (pid {procs[spec].pid})")
+        time.sleep(0.5)
+
+    logger.info("🛑 Stopping all processes...")
+    for p in procs.values():
+        if p.poll() is None:
+            p.send_signal(signal.SIGTERM)
+    for p in procs.values():
+        try:
+            p.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+if __name__ == "__main__":
+    main()